@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# Offline benchmark for owr: generates synthetic bare repositories and serves source lists shaped like
+# sources/skadate-release from a local HTTP server, then runs clone and update end to end through Builder.process.
+#
+#   ./bench.py --repos 60 --commits 50 -- --jobs 8 --depth 1
+#
+# Everything after "--" is passed to owr as is.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+import SimpleHTTPServer
+
+import owr
+
+REPO_HOST = "bench.invalid"
+ORGS = ["oxwall", "skalfa"]
+
+
+def _fast_import(git_dir, name, commits, files, file_size, offset=0):
+    stream = []
+    for c in range(offset, offset + commits):
+        message = "%s commit %d" % (name, c)
+        stream.append("commit refs/heads/master")
+        stream.append("committer bench <bench@example.com> %d +0000" % (1500000000 + c))
+        stream.append("data %d" % len(message))
+        stream.append(message)
+        if c == offset and offset:
+            stream.append("from refs/heads/master^0")
+
+        for f in range(files):
+            # every commit touches a few files, so history size grows with --commits
+            if c == 0 or f % max(commits, 1) == c % max(commits, 1) or f == 0:
+                content = ("%s %d %d\n" % (name, c, f)) * max(file_size / 16, 1)
+                stream.append("M 644 inline %s" % _file_name(name, f))
+                stream.append("data %d" % len(content))
+                stream.append(content)
+        stream.append("")
+
+    sp = subprocess.Popen(["git", "--git-dir=%s" % git_dir, "fast-import", "--quiet"], stdin=subprocess.PIPE)
+    sp.communicate("\n".join(stream) + "\n")
+
+
+def _file_name(name, index):
+    if name == "oxwall":
+        layout = ["ow_includes/config.php.default", "ow_userfiles/index.html", "ow_pluginfiles/index.html",
+                  "ow_static/index.html", "ow_log/index.html", "ow_smarty/index.html", "ow_version.xml"]
+        if index < len(layout):
+            return layout[index]
+
+    return "src/file%d.php" % index
+
+
+def _create_repo(root, org, name, options, offset=0):
+    git_dir = os.path.join(root, org, "%s.git" % name)
+    if not os.path.isdir(git_dir):
+        subprocess.check_call(["git", "init", "--quiet", "--bare", git_dir])
+
+    files = max(options.files, 7) if name == "oxwall" else options.files
+    _fast_import(git_dir, name, options.commits if not offset else 1, files, options.fileSize, offset)
+
+
+class _Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    directory = None
+
+    def translate_path(self, path):
+        # the lists are served from their own folder, not from the working directory
+        return os.path.join(self.directory, path.split("?", 1)[0].lstrip("/"))
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(directory):
+    _Handler.directory = directory
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _Handler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+
+def _write_lists(directory, plugins, themes):
+    os.makedirs(os.path.join(directory, "include"))
+
+    with open(os.path.join(directory, "core"), "w") as f:
+        f.write("[core %s/oxwall]\noxwall\n\n[install %s/oxwall]\ninstall\n" % (REPO_HOST, REPO_HOST))
+
+    includes = []
+    for org in ORGS:
+        names = [name for owner, name in plugins if owner == org]
+        with open(os.path.join(directory, "include", "%s-plugins" % org), "w") as f:
+            f.write("[plugins %s/%s]\n\n%s\n" % (REPO_HOST, org, "\n".join(names)))
+        includes.append("<include ./include/%s-plugins>" % org)
+
+    with open(os.path.join(directory, "release"), "w") as f:
+        f.write("<include ./core>\n%s\n\n[themes %s/oxwall]\n\n%s\n" % (
+            "\n".join(includes), REPO_HOST, "\n".join(name for owner, name in themes)))
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+
+    return values[index]
+
+
+def _run(command, source, site, owr_options, verbose):
+    sys.argv = ["owr", command, source, site] + owr_options
+
+    commands = [owr.CloneCommand(), owr.UpdateCommand(), owr.MigrateCommand()]
+    arguments = owr.Arguments(commands)
+    arguments.parse()
+
+    owr._timings = owr.Timings()
+    owr.setup(arguments)
+    owr._timings.enabled = True
+
+    stdout = os.dup(1)
+    if not verbose:
+        sys.stdout.flush()
+        with open(os.devnull, "w") as devnull:
+            os.dup2(devnull.fileno(), 1)
+
+    started = time.time()
+    try:
+        builder = owr.Builder(arguments, commands)
+        builder.process()
+    finally:
+        seconds = time.time() - started
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.close(stdout)
+
+    latencies = [r["seconds"] for r in owr._timings.records if r["phase"] in ("main", "item")]
+
+    return {
+        "command": command,
+        "repos": len(latencies),
+        "seconds": round(seconds, 3),
+        "repos_per_second": round(len(latencies) / seconds, 2) if seconds else 0,
+        "p50": _percentile(latencies, 50),
+        "p90": _percentile(latencies, 90),
+        "p99": _percentile(latencies, 99),
+        "max": max(latencies) if latencies else 0,
+        "failures": len(builder.failures),
+        "phases": owr._timings.report()["phases"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark owr clone and update against local stand-ins")
+    parser.add_argument("--repos", dest="repos", type=int, default=60, help="Number of plugin repositories")
+    parser.add_argument("--themes", dest="themes", type=int, default=3, help="Number of theme repositories")
+    parser.add_argument("--commits", dest="commits", type=int, default=20, help="Commits per repository")
+    parser.add_argument("--files", dest="files", type=int, default=20, help="Files per repository")
+    parser.add_argument("--file-size", dest="fileSize", type=int, default=4096, help="File size in bytes")
+    parser.add_argument("--changed", dest="changed", type=int, default=10,
+                        help="Percentage of repositories that get a new commit before update")
+    parser.add_argument("--runs", dest="runs", type=int, default=1, help="Number of clone/update rounds")
+    parser.add_argument("--json", dest="json", action="store_true", help="Print the results as json")
+    parser.add_argument("--keep", dest="keep", action="store_true", help="Keep the generated files")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Show owr output")
+    parser.add_argument("owr", nargs=argparse.REMAINDER, help="Options passed to owr (after --)")
+    options = parser.parse_args()
+
+    owr_options = [o for o in options.owr if o != "--"]
+
+    work_dir = tempfile.mkdtemp(prefix="owr-bench-")
+    repos_dir = os.path.join(work_dir, "repos")
+    lists_dir = os.path.join(work_dir, "lists")
+
+    # repository urls in the lists point to a host that does not exist, git maps it to the local bare repos
+    os.environ["GIT_CONFIG_COUNT"] = "1"
+    os.environ["GIT_CONFIG_KEY_0"] = "url.file://%s/.insteadOf" % repos_dir
+    os.environ["GIT_CONFIG_VALUE_0"] = "https://%s/" % REPO_HOST
+    owr.SOURCES_CACHE_DIR = os.path.join(work_dir, "sources-cache")
+
+    plugins = [(ORGS[i % len(ORGS)], "plugin%03d" % i) for i in range(options.repos)]
+    themes = [("oxwall", "theme%02d" % i) for i in range(options.themes)]
+
+    started = time.time()
+    for org, name in [("oxwall", "oxwall"), ("oxwall", "install")] + plugins + themes:
+        _create_repo(repos_dir, org, name, options)
+    _write_lists(lists_dir, plugins, themes)
+    setup_seconds = time.time() - started
+
+    server, url = _serve(lists_dir)
+
+    results = []
+    try:
+        for run in range(options.runs):
+            site = os.path.join(work_dir, "site%d" % run)
+            results.append(_run("clone", "%s/release" % url, site, owr_options, options.verbose))
+
+            changed = plugins[:len(plugins) * options.changed / 100]
+            for org, name in changed:
+                _create_repo(repos_dir, org, name, options, offset=options.commits + run + 1)
+
+            results.append(_run("update", "%s/release" % url, site, owr_options, options.verbose))
+    finally:
+        server.shutdown()
+        if not options.keep:
+            shutil.rmtree(work_dir, True)
+
+    if options.json:
+        print json.dumps({"setup_seconds": round(setup_seconds, 3), "options": owr_options, "results": results},
+                         indent=4, sort_keys=True)
+        return
+
+    print "setup: %.3fs, %d repositories, owr options: %s" % (
+        setup_seconds, len(plugins) + len(themes) + 2, " ".join(owr_options) or "(none)")
+    print "%-8s %6s %9s %9s %8s %8s %8s %8s %8s" % (
+        "command", "repos", "seconds", "repos/s", "p50", "p90", "p99", "max", "failed")
+    for r in results:
+        print "%-8s %6d %9.3f %9.2f %8.3f %8.3f %8.3f %8.3f %8d" % (
+            r["command"], r["repos"], r["seconds"], r["repos_per_second"], r["p50"], r["p90"], r["p99"], r["max"],
+            r["failures"])
+
+    if options.keep:
+        print "files kept in %s" % work_dir
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,58 @@
 #!/usr/bin/env python
 
 import argparse
+import atexit
 import base64
+import contextlib
 import getpass
+import grp
+import hashlib
+import httplib
+import json
 import os
+import pipes
+import pwd
+import random
 import re
+import stat
 import sys
+import shlex
 import shutil
+import socket
 import subprocess
+import tarfile
 import tempfile
+import threading
+import time
+import urllib
 import urllib2
+import urlparse
+import Queue
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 SOURCE_URL_PREFIX = "https://raw.githubusercontent.com/oxwall/owr/master/sources"
-COMPOSER_DOWNLOAD_URL = 'https://getcomposer.org/composer.phar'
+ARCHIVE_URL = "https://codeload.github.com"
+COMPOSER_DOWNLOAD_URL = 'https://getcomposer.org/download/latest-stable/composer.phar'
+COMPOSER_CHECKSUM_URL = COMPOSER_DOWNLOAD_URL + '.sha256sum'
+COMPOSER_DIR = os.path.join(os.path.expanduser("~"), ".owr", "composer")
+COMPOSER_MAX_AGE = 7 * 24 * 60 * 60
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".owr", "cache")
+SOURCES_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".owr", "sources")
+MAX_BACKOFF = 60
+SSH_CONTROL_PERSIST = 60
+RATE_LIMITED = re.compile("rate limit|too many requests|\\b429\\b", re.I)
+GIT_PROGRESS = re.compile("^(?:remote: )?([A-Z][a-z ]+):\\s+(\\d+)% \\((\\d+)/(\\d+)\\)(?:, ([\\d.]+) ([KMG]?i?B))?")
+GIT_TRANSFER = re.compile("^(Cloning into |From | [ *+!=-] |remote: Total |(remote: )?[A-Z][a-z ]+: +\\d+(%|, done))")
+BYTE_UNITS = {"bytes": 1, "B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3}
+NOT_RETRIED = re.compile("not found|does not exist|authentication failed|invalid username or password", re.I)
+WRITABLE_DIRS = ["ow_userfiles", "ow_pluginfiles", "ow_static", "ow_log", os.path.join("ow_smarty", "template_c")]
 
 
 def _is_file(file_path):
@@ -30,6 +70,20 @@ def _is_relative_url(url):
 def _is_absolute_url(url):
     return url.startswith(("http://", "https://"))
 
+def _strip_auth(url):
+    return re.sub("^(https?://)[^@/]+@", r"\1", url)
+
+
+def _to_str(value):
+    # json gives unicode back, everything else in here works with byte strings
+    if isinstance(value, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return map(_to_str, value)
+
+    return value.encode("utf-8") if isinstance(value, unicode) else value
+
+
 def _get_ssh_url(url):
     return url.replace('https://', 'git@').replace('http://', 'git@')
 
@@ -42,18 +96,992 @@ def ssh_url(f):
     return wrapper
 
 
-def _change_branch(directory, branch, is_quiet=True):
-    quiet = "--quiet" if is_quiet else ""
-    os.system(
-        ("git --work-tree=%s --git-dir=%s fetch " + quiet + " origin %s") % (
-            directory + os.sep, os.path.join(directory, ".git"), branch
-        )
-    )
-    os.system(
-        ("git --work-tree=%s --git-dir=%s checkout " + quiet + " origin/%s") % (
-            directory + os.sep, os.path.join(directory, ".git"), branch
-        )
-    )
+_output = threading.local()
+_print_lock = threading.Lock()
+
+
+def _print(message):
+    buffer = getattr(_output, "buffer", None)
+    if buffer is None:
+        print message
+    else:
+        buffer.append(message)
+
+
+def _flush_output(buffer):
+    if buffer:
+        with _print_lock:
+            print "\n".join(buffer)
+
+
+class Runner:
+    def __init__(self):
+        self.timeout = None
+        self._slots = threading.BoundedSemaphore(16)
+        self._deadlines = {}
+        self._watch = threading.Condition()
+        self._watchdog = None
+        self._stopped = False
+
+    def _watch_processes(self):
+        # one thread for all timeouts instead of a timer thread per process
+        with self._watch:
+            while not self._stopped:
+                now = time.time()
+                for sp, (deadline, expired) in self._deadlines.items():
+                    if deadline <= now:
+                        del self._deadlines[sp]
+                        expired.append(True)
+                        try:
+                            sp.kill()
+                        except OSError:
+                            pass
+
+                if self._deadlines:
+                    self._watch.wait(min(d for d, e in self._deadlines.values()) - now)
+                else:
+                    self._watch.wait()
+
+    def stop(self):
+        # a daemon thread still running while the interpreter is torn down dies with a traceback
+        with self._watch:
+            self._stopped = True
+            self._watch.notify()
+
+        if self._watchdog is not None:
+            self._watchdog.join()
+
+    def _deadline(self, sp, timeout, expired):
+        with self._watch:
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(target=self._watch_processes)
+                self._watchdog.daemon = True
+                self._watchdog.start()
+
+            if timeout:
+                self._deadlines[sp] = (time.time() + timeout, expired)
+            else:
+                self._deadlines.pop(sp, None)
+            self._watch.notify()
+
+    def configure(self, max_processes, timeout):
+        self._slots = threading.BoundedSemaphore(max(max_processes, 1))
+        self.timeout = timeout or None
+
+    def _stream(self, sp, progress):
+        # git rewrites progress lines with \r, those go to the callback and never into the output
+        output = []
+        pending = ""
+        while True:
+            data = os.read(sp.stdout.fileno(), 4096)
+            if not data:
+                break
+
+            parts = re.split("([\r\n])", pending + data)
+            pending = parts.pop()
+            for line, end in zip(parts[0::2], parts[1::2]):
+                if GIT_PROGRESS.match(line):
+                    progress(line)
+                elif not GIT_TRANSFER.match(line):
+                    output.append(line + end)
+
+        sp.wait()
+
+        return "".join(output) + pending
+
+    def execute(self, argv, cwd=None, env=None, capture=True, timeout=None, stderr=subprocess.STDOUT,
+                progress=None):
+        timeout = timeout or self.timeout
+        capture = capture or progress is not None
+
+        with self._slots:
+            sp = subprocess.Popen(argv, cwd=cwd, env=env,
+                                  stdout=subprocess.PIPE if capture else None,
+                                  stderr=stderr if capture else None)
+
+            expired = []
+            if timeout:
+                self._deadline(sp, timeout, expired)
+            try:
+                result = self._stream(sp, progress) if progress else sp.communicate()[0] or ""
+            finally:
+                if timeout:
+                    self._deadline(sp, None, expired)
+
+        if expired:
+            result += "\ntimed out after %s seconds" % timeout
+
+        return sp.returncode, result
+
+
+_runner = Runner()
+atexit.register(_runner.stop)
+
+
+class Throttle:
+    def __init__(self):
+        self.retries = 3
+        self.delay = 1.0
+        self._max = self._limit = 16
+        self._active = 0
+        self._until = 0
+        self._condition = threading.Condition()
+
+    def configure(self, retries, delay, concurrency):
+        self.retries = max(retries, 0)
+        self.delay = delay
+        self._max = self._limit = max(concurrency, 1)
+
+    def backoff(self, attempt):
+        # full jitter, so workers that failed together do not come back together
+        return random.uniform(0, min(self.delay * 2 ** attempt, MAX_BACKOFF))
+
+    def acquire(self):
+        with self._condition:
+            while self._active >= self._limit or time.time() < self._until:
+                self._condition.wait(max(self._until - time.time(), 0.1))
+            self._active += 1
+
+    def release(self, rate_limited=False, retry_after=None):
+        with self._condition:
+            self._active -= 1
+            if rate_limited:
+                # every network operation backs off, not only the one that hit the limit
+                self._limit = max(self._limit / 2, 1)
+                self._until = max(self._until, time.time() + (retry_after or self.backoff(self.retries)))
+            elif self._limit < self._max:
+                self._limit += 1
+            self._condition.notify_all()
+
+
+_throttle = Throttle()
+
+
+class SshMaster:
+    def __init__(self):
+        self.command = None
+        self._dir = None
+
+    def _options(self):
+        # %C hashes user, host and port, so every host gets one master connection
+        return ["-o", "ControlMaster=auto", "-o", "ControlPath=%s" % os.path.join(self._dir, "%C"),
+                "-o", "ControlPersist=%d" % SSH_CONTROL_PERSIST]
+
+    def start(self, command):
+        self.stop()
+        self.command = command
+        # unix socket paths are limited to about a hundred characters, a home folder may already be too deep
+        self._dir = tempfile.mkdtemp(prefix="owr-ssh-")
+        os.environ["GIT_SSH_COMMAND"] = " ".join([command] + map(pipes.quote, self._options()))
+
+    def connect(self, urls):
+        if self._dir is None:
+            return
+
+        # parallel jobs would race to become the master, so masters are opened before any of them starts
+        # only scp style user@host:path urls go over ssh, https ones from a lock file do not
+        hosts = sorted(set(m.group(1) for m in (re.match("^([^/:@]+@[^/:]+):", url) for url in urls) if m))
+        for host in hosts:
+            argv = shlex.split(self.command) + self._options()
+            if _runner.execute(argv + ["-O", "check", host])[0] == 0:
+                continue
+
+            # not captured, a backgrounded master must not hold our pipe open
+            if _runner.execute(argv + ["-f", "-N", host], capture=False)[0] != 0:
+                _print("Could not open a master connection to %s, every command connects on its own" % host)
+
+    def stop(self):
+        if self._dir is None:
+            return
+
+        for name in os.listdir(self._dir):
+            try:
+                _runner.execute(shlex.split(self.command) +
+                                ["-o", "ControlPath=%s" % os.path.join(self._dir, name), "-O", "exit", "owr"])
+            except OSError:
+                pass
+
+        shutil.rmtree(self._dir, True)
+        self._dir = None
+
+
+_ssh = SshMaster()
+atexit.register(_ssh.stop)
+
+
+def _run(argv, cwd=None, env=None, timeout=None, retry=False):
+    buffer = getattr(_output, "buffer", None)
+
+    if buffer is not None:
+        # nobody can answer a credentials prompt while several repositories are processed at once
+        env = dict(env or os.environ, GIT_TERMINAL_PROMPT="0")
+
+    attempts = _throttle.retries + 1 if retry else 1
+    progress = _progress.update if "--progress" in argv else None
+    for attempt in range(attempts):
+        if retry:
+            _throttle.acquire()
+
+        try:
+            code, result = _runner.execute(argv, cwd, env, buffer is not None, timeout, progress=progress)
+        except OSError as e:
+            code, result = 127, "%s: %s" % (argv[0], e.strerror)
+
+        if retry:
+            _throttle.release(code != 0 and RATE_LIMITED.search(result) is not None)
+
+        # without a buffer the output went straight to the terminal, only our own messages are left here
+        if result.strip():
+            _print(result.rstrip("\n"))
+
+        if code == 0 or attempt == attempts - 1 or code == 127 or NOT_RETRIED.search(result):
+            break
+
+        delay = _throttle.backoff(attempt)
+        _print("retrying in %.1f seconds (%d of %d)" % (delay, attempt + 1, attempts - 1))
+        time.sleep(delay)
+
+    failures = getattr(_output, "failures", None)
+    if code != 0 and failures is not None:
+        failures.append(" ".join(map(_strip_auth, argv)))
+        if retry:
+            # only a failed transfer is worth trying again from a mirror
+            _output.transfer_failed = True
+
+    _timings.exit_code(code)
+
+    return code
+
+
+def _git(directory, *args):
+    return ["git", "--work-tree=%s" % (directory + os.sep), "--git-dir=%s" % os.path.join(directory, ".git")] + \
+        list(args)
+
+
+def _quiet(args):
+    return [] if args.verbose else ["--quiet"]
+
+
+def _disk_usage(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+
+    return size
+
+
+class Timings:
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _current(self):
+        phases = getattr(_output, "phases", None)
+        return phases[-1] if phases else None
+
+    @contextlib.contextmanager
+    def phase(self, phase, repo, git_dir=None):
+        record = {"phase": phase, "repo": repo, "exit_codes": [], "bytes": None}
+
+        # git transfer size is estimated from the growth of the object store, only when a report was asked for
+        size = _disk_usage(git_dir) if self.enabled and git_dir else None
+
+        if getattr(_output, "phases", None) is None:
+            _output.phases = []
+        _output.phases.append(record)
+
+        started = time.time()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.time() - started, 3)
+            _output.phases.pop()
+
+            if size is not None and os.path.isdir(git_dir):
+                record["bytes"] = max(_disk_usage(git_dir) - size, 0)
+
+            with self._lock:
+                self.records.append(record)
+
+    def exit_code(self, code):
+        record = self._current()
+        if record is not None:
+            record["exit_codes"].append(code)
+
+    def transferred(self, size):
+        record = self._current()
+        if record is not None:
+            record["bytes"] = (record["bytes"] or 0) + size
+
+    def report(self):
+        phases = {}
+        repositories = {}
+        for record in self.records:
+            phase = phases.setdefault(record["phase"], {"count": 0, "seconds": 0.0, "max": 0.0, "bytes": 0})
+            phase["count"] += 1
+            phase["seconds"] = round(phase["seconds"] + record["seconds"], 3)
+            phase["max"] = max(phase["max"], record["seconds"])
+            phase["bytes"] += record["bytes"] or 0
+
+            repository = repositories.setdefault(record["repo"], {})
+            repository[record["phase"]] = round(repository.get(record["phase"], 0) + record["seconds"], 3)
+
+        return {"seconds": round(time.time() - self.started, 3), "phases": phases, "repositories": repositories,
+                "records": self.records}
+
+    def write(self, output_format, path):
+        report = self.report()
+
+        if output_format == "json":
+            data = json.dumps(report, indent=4, sort_keys=True)
+        else:
+            lines = ["Total: %.3fs" % report["seconds"], "", "%-16s %6s %10s %10s %12s" % (
+                "phase", "count", "seconds", "max", "bytes")]
+            for name, phase in sorted(report["phases"].items(), key=lambda p: -p[1]["seconds"]):
+                lines.append("%-16s %6d %10.3f %10.3f %12d" % (
+                    name, phase["count"], phase["seconds"], phase["max"], phase["bytes"]))
+
+            lines.extend(["", "Slowest repositories:"])
+            slowest = sorted(report["repositories"].items(), key=lambda r: -sum(r[1].values()))[:10]
+            for repo, repo_phases in slowest:
+                lines.append("%10.3f  %s" % (sum(repo_phases.values()), repo))
+            data = "\n".join(lines)
+
+        if path:
+            with open(path, "w") as f:
+                f.write(data + "\n")
+        else:
+            print data
+
+
+_timings = Timings()
+
+
+class HttpResponse:
+    def __init__(self, client, key, connection, response):
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def info(self):
+        return self._response.msg
+
+    def read(self, size=None):
+        data = self._response.read(size) if size else self._response.read()
+        if not size or not data:
+            self.close()
+
+        return data
+
+    def close(self):
+        if self._connection is None:
+            return
+
+        # a fully read response leaves the connection ready for the next request to the same host
+        if self._response.isclosed() and not self._response.will_close:
+            self._client.release(self._key, self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
+
+
+class HttpClient:
+    def __init__(self):
+        self.proxy = None
+        self.timeout = None
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _proxy(self, scheme, host):
+        proxy = self.proxy or urllib.getproxies().get(scheme)
+        if not proxy or urllib.proxy_bypass_environment(host):
+            return None
+
+        return urlparse.urlsplit(proxy if "://" in proxy else "http://%s" % proxy)
+
+    def _connect(self, key):
+        scheme, host, port = key
+        connection_class = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+
+        proxy = self._proxy(scheme, host)
+        if proxy is None:
+            return connection_class(host, port, timeout=self.timeout)
+
+        connection = connection_class(proxy.hostname, proxy.port or 8080, timeout=self.timeout)
+        if scheme == "https":
+            connection.set_tunnel(host, port)
+
+        return connection
+
+    def release(self, key, connection):
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+
+    def _request(self, connection, path, headers):
+        connection.request("GET", path, headers=headers)
+        return connection.getresponse()
+
+    def open(self, url, headers=None, redirects=5):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        if parts.scheme == "http" and self._proxy(parts.scheme, parts.hostname):
+            path = url
+
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+
+        try:
+            if connection is None:
+                connection = self._connect(key)
+                response = self._request(connection, path, headers or {})
+            else:
+                try:
+                    response = self._request(connection, path, headers or {})
+                except (httplib.HTTPException, socket.error):
+                    # the server closed an idle keep-alive connection, that is not an error
+                    connection.close()
+                    connection = self._connect(key)
+                    response = self._request(connection, path, headers or {})
+        except (httplib.HTTPException, socket.error) as e:
+            connection.close()
+            raise urllib2.URLError(e)
+
+        result = HttpResponse(self, key, connection, response)
+
+        if response.status in (301, 302, 303, 307, 308) and redirects and response.getheader("Location"):
+            result.read()
+            location = urlparse.urljoin(url, response.getheader("Location"))
+            if urlparse.urlsplit(location).hostname != parts.hostname:
+                headers = dict((k, v) for k, v in (headers or {}).items() if k != "Authorization")
+            return self.open(location, headers, redirects - 1)
+
+        if response.status >= 300:
+            result.read()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+
+        return result
+
+
+_http = HttpClient()
+
+
+def _urlopen(url, headers=None):
+    attempt = 0
+    while True:
+        _throttle.acquire()
+        rate_limited = False
+        retry_after = None
+        try:
+            return _http.open(url, headers)
+        except urllib2.HTTPError as e:
+            rate_limited = e.code == 429 or (e.code == 403 and e.info().get("X-RateLimit-Remaining") == "0")
+            if e.info().get("Retry-After", "").isdigit():
+                retry_after = int(e.info().get("Retry-After"))
+            if attempt >= _throttle.retries or not (rate_limited or e.code >= 500):
+                raise
+        except urllib2.URLError:
+            if attempt >= _throttle.retries:
+                raise
+        finally:
+            _throttle.release(rate_limited, retry_after)
+
+        time.sleep(retry_after or _throttle.backoff(attempt))
+        attempt += 1
+
+
+class Progress:
+    def __init__(self):
+        self.mode = None
+        self.interval = 2
+        self._lock = threading.Lock()
+        self._repos = {}
+
+    def _emit(self, event, **data):
+        if self.mode == "json":
+            data.update({"event": event, "time": round(time.time(), 3)})
+            line = json.dumps(data, sort_keys=True)
+        elif event == "status":
+            in_flight = ", ".join("%s %ds%s" % (r["path"], r["seconds"], " %d%%" % r["percent"] if r["percent"] else "")
+                                  for r in data["slowest"])
+            line = "[%d/%d] %s/s, eta %s%s" % (data["done"], data["total"], _format_size(data["bytes_per_second"]),
+                                                "%ds" % data["eta"] if data["eta"] is not None else "-",
+                                                ", in flight: %s" % in_flight if in_flight else "")
+        elif event == "repo_done":
+            line = "%s %s in %.1fs" % ("done" if data["ok"] else "failed", data["path"], data["seconds"])
+        else:
+            return
+
+        with _print_lock:
+            sys.stderr.write(line + "\n")
+            sys.stderr.flush()
+
+    def _status(self):
+        now = time.time()
+        self._reported = now
+
+        elapsed = now - self._started
+        in_flight = sorted(self._repos.values(), key=lambda r: r["started"])[:3]
+        eta = None
+        if self._done:
+            eta = int(elapsed / self._done * (self._total - self._done))
+
+        transferred = self._bytes + sum(r["bytes"] for r in self._repos.values())
+        self._emit("status", done=self._done, total=self._total, eta=eta, bytes=transferred,
+                   bytes_per_second=int(transferred / max(elapsed, 1)),
+                   slowest=[{"path": r["path"], "seconds": int(now - r["started"]), "percent": r["percent"]}
+                            for r in in_flight])
+
+    def start(self, root_dir, total):
+        if not self.mode:
+            return
+
+        self._root_dir = os.path.abspath(root_dir)
+        self._total = total
+        self._done = 0
+        self._bytes = 0
+        self._started = self._reported = time.time()
+        self._emit("start", total=total)
+
+    def begin(self, path):
+        if not self.mode:
+            return
+
+        with self._lock:
+            self._repos[threading.current_thread().ident] = {
+                "path": os.path.relpath(path, self._root_dir), "started": time.time(), "bytes": 0, "percent": 0}
+            self._emit("repo_start", path=os.path.relpath(path, self._root_dir))
+
+    def update(self, line):
+        match = GIT_PROGRESS.match(line)
+        if not self.mode or not match:
+            return
+
+        with self._lock:
+            repo = self._repos.get(threading.current_thread().ident)
+            if repo is None:
+                return
+
+            if match.group(1) == "Receiving objects":
+                repo["percent"] = int(match.group(2))
+                if match.group(5):
+                    repo["bytes"] = int(float(match.group(5)) * BYTE_UNITS.get(match.group(6), 1))
+
+            if time.time() - self._reported >= self.interval:
+                self._status()
+
+    def end(self, ok):
+        if not self.mode:
+            return
+
+        with self._lock:
+            repo = self._repos.pop(threading.current_thread().ident)
+            self._done += 1
+            self._bytes += repo["bytes"]
+            self._emit("repo_done", path=repo["path"], ok=ok, seconds=round(time.time() - repo["started"], 3),
+                       bytes=repo["bytes"])
+
+            if time.time() - self._reported >= self.interval or self._done == self._total:
+                self._status()
+
+    def finish(self):
+        if not self.mode:
+            return
+
+        self._emit("finish", done=self._done, total=self._total, bytes=self._bytes,
+                   seconds=round(time.time() - self._started, 3))
+
+
+_progress = Progress()
+
+
+def _transfer_options(args):
+    # --quiet would hide the local side of the progress report
+    return ["--progress"] if _progress.mode else _quiet(args)
+
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "%d %s" % (size, unit)
+        size /= 1024.0
+
+    return "%.1f GiB" % size
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), ""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _parallel(func, items, jobs):
+    results = [None] * len(items)
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return map(func, items)
+
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # join with a timeout so that KeyboardInterrupt still reaches the main thread
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+
+    # a failed worker is reported to the caller like a failure in the sequential map
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    return results
+
+
+def _git_output(*args, **options):
+    try:
+        with open(os.devnull, "w") as devnull:
+            code, result = _runner.execute(["git"] + list(args), env=options.get("env"), stderr=devnull)
+    except OSError:
+        return None
+
+    return result.strip() if code == 0 else None
+
+
+def _checkout_commit(directory, commit, args):
+    if _git_output("--git-dir=%s" % os.path.join(directory, ".git"), "rev-parse", "-q", "--verify", "HEAD") == commit:
+        return
+
+    if _git_output("--git-dir=%s" % os.path.join(directory, ".git"), "cat-file", "-e", "%s^{commit}" % commit) is None:
+        _run(_git(directory, "fetch", *(_transfer_options(args) + _fetch_options(args) +
+                                        ["origin", commit])), retry=True)
+
+    _run(_git(directory, "checkout", *(_quiet(args) + (["--force"] if args.clearChanges else []) + [commit])))
+
+
+def _change_branch(directory, branch, args):
+    with _timings.phase("change_branch", directory, os.path.join(directory, ".git")):
+        _switch_branch(directory, branch, args)
+
+
+def _switch_branch(directory, branch, args):
+    # repositories are cloned with --branch, so origin/<branch> is already there
+    _run(_git(directory, "checkout", *(_quiet(args) + ["origin/%s" % branch])))
+
+
+def _fetch_branch(directory, url, branch, args):
+    remote = url
+    if args.workspace:
+        # the shared mirror is already an alternate of the site repository, nothing is copied
+        remote = args.workspace.mirror(url) or remote
+
+    # one fetch for the target branch only, the explicit refspec also covers single branch (shallow) clones
+    return _run(_git(directory, "fetch", *(_transfer_options(args) + _fetch_options(args) +
+                                           [remote, "+refs/heads/%s:refs/remotes/origin/%s" % (branch, branch)])),
+                retry=True)
+
+
+def _sparse_options(sparse):
+    # only top level files are checked out by the clone, _sparse_checkout adds the profile directories
+    return ("--sparse",) if sparse is not None else ()
+
+
+def _sparse_checkout(directory, sparse, args):
+    if sparse is not None:
+        _run(_git(directory, "sparse-checkout", "set", "--cone", *sparse))
+    elif os.path.isfile(os.path.join(directory, ".git", "info", "sparse-checkout")):
+        # the profile was removed from the source list, the full tree comes back
+        _run(_git(directory, "sparse-checkout", "disable"))
+
+
+def _update_branch(directory, url, branch, args, sparse=None):
+    if not args.noFetch:
+        _fetch_branch(directory, url, branch, args)
+
+    _sparse_checkout(directory, sparse, args)
+
+    if args.clearChanges:
+        _run(_git(directory, "checkout", *(_quiet(args) + ["--", "."])))
+
+    if branch == "master" and args.depth:
+        # a shallow fetch has no common history to merge with, local master is moved to the fetched commit
+        _run(_git(directory, "checkout", *(_quiet(args) + ["-B", "master", "origin/master"])))
+    elif branch == "master":
+        _run(_git(directory, "checkout", *(_quiet(args) + ["master"])))
+        _run(_git(directory, "merge", *(_quiet(args) + (["--ff-only"] if args.ffOnly else []) + ["origin/master"])))
+    else:
+        _run(_git(directory, "checkout", *(_quiet(args) + ["origin/%s" % branch])))
+
+
+def _fetch_options(args):
+    options = []
+    if args.depth:
+        options += ["--depth", str(args.depth)]
+
+    return options
+
+
+def _clone_options(url, args):
+    options = _fetch_options(args)
+    if args.filter:
+        options += ["--filter=%s" % args.filter]
+
+    if args.workspace:
+        mirror = args.workspace.mirror(url)
+        if mirror:
+            options += ["--reference", mirror]
+    elif args.objectCache:
+        mirror = args.objectCache.mirror(url)
+        if mirror:
+            options += ["--reference", mirror, "--dissociate"]
+
+    return options
+
+
+def _clone(url, path, args, branch, *options):
+    if branch != "master":
+        # the branch is checked out detached afterwards, so the master working tree is never written
+        options = ("--no-checkout", "--branch", branch) + options
+
+    return _run(["git", "clone"] + _transfer_options(args) + _clone_options(url, args) + list(options) +
+                [url, path], retry=True)
+
+
+def _in_cone(name, is_dir, sparse):
+    if any(name == d or name.startswith(d + "/") for d in sparse):
+        return True
+
+    # like a cone mode checkout, files next to the folders on the way to a profile folder are kept too
+    parent = name.rsplit("/", 1)[0] if "/" in name else ""
+    return not is_dir and (not parent or any(d.startswith(parent + "/") for d in sparse))
+
+
+def _archive_commit(path):
+    metadata_path = os.path.join(path, ".owr-archive")
+    if not os.path.isfile(metadata_path):
+        return None
+
+    with open(metadata_path) as f:
+        return json.load(f).get("commit")
+
+
+def _download_archive(url, path, ref, args, sparse=None):
+    owner, name = re.search("[/:]([^/:]+)/([^/]+?)(?:\\.git)?$", url).groups()
+    archive_url = "%s/%s/%s/tar.gz/%s" % (args.archiveUrl.rstrip("/"), owner, name, urllib.quote(ref))
+
+    headers = {}
+    parts = urlparse.urlsplit(url)
+    if "://" in url and parts.username:
+        credentials = "%s:%s" % (urllib.unquote(parts.username), urllib.unquote(parts.password or ""))
+        headers["Authorization"] = "Basic %s" % base64.b64encode(credentials)
+
+    if sparse is not None:
+        sparse = [d.strip("/") for d in sparse]
+
+    response = _urlopen(archive_url, headers)
+
+    # members are written while the response is read, the archive itself never touches the disk
+    archive = tarfile.open(fileobj=response, mode="r|gz")
+    for member in archive:
+        # everything is inside a <repository>-<ref> folder
+        member_name = member.name.split("/", 1)[1] if "/" in member.name else ""
+        if not member_name or member_name.startswith("/") or ".." in member_name.split("/"):
+            continue
+
+        if sparse is not None and not _in_cone(member_name, member.isdir(), sparse):
+            continue
+
+        member.name = member_name
+        archive.extract(member, path)
+
+    # git archive stores the commit in the global pax header, codeload archives are made by it
+    commit = archive.pax_headers.get("comment")
+    archive.close()
+    response.read()
+
+    with open(os.path.join(path, ".owr-archive"), "w") as f:
+        json.dump({"url": _strip_auth(url), "ref": ref, "commit": commit}, f, indent=4, sort_keys=True)
+        f.write("\n")
+
+
+class PermissionFixer:
+    def __init__(self, dir_mode, file_mode, uid=-1, gid=-1, since=None):
+        self.dir_mode = dir_mode
+        self.file_mode = file_mode
+        self.uid = uid
+        self.gid = gid
+        self.since = since
+        self.errors = []
+
+    def _entries(self, directory):
+        if _scandir is not None:
+            for entry in _scandir(directory):
+                # d_type from readdir, no stat call per entry
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.name, True
+                elif not entry.is_symlink():
+                    yield entry.name, False
+        else:
+            for name in os.listdir(directory):
+                mode = os.lstat(os.path.join(directory, name)).st_mode
+                if not stat.S_ISLNK(mode):
+                    yield name, stat.S_ISDIR(mode)
+
+    def _apply(self, path, st, mode):
+        changed = 0
+        try:
+            if stat.S_IMODE(st.st_mode) != mode:
+                os.chmod(path, mode)
+                changed = 1
+
+            if (self.uid != -1 and st.st_uid != self.uid) or (self.gid != -1 and st.st_gid != self.gid):
+                os.lchown(path, self.uid, self.gid)
+                changed = 1
+        except OSError as e:
+            # like chmod -R, one entry owned by someone else does not stop the rest
+            self.errors.append("%s: %s" % (path, e.strerror))
+
+        return changed
+
+    def fix(self, path):
+        # a deploy links shared folders into every release, their targets get the permissions
+        path = os.path.realpath(path)
+        if not os.path.isdir(path):
+            return self._apply(path, os.lstat(path), self.file_mode) if os.path.isfile(path) else 0
+
+        changed = 0
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            try:
+                st = os.lstat(directory)
+                changed += self._apply(directory, st, self.dir_mode)
+
+                # no entry was added to a directory that was not modified since the last run,
+                # so in incremental mode its files are not even looked at
+                check_files = self.since is None or st.st_mtime >= self.since
+
+                for name, is_dir in self._entries(directory):
+                    entry_path = os.path.join(directory, name)
+                    if is_dir:
+                        stack.append(entry_path)
+                    elif check_files:
+                        changed += self._apply(entry_path, os.lstat(entry_path), self.file_mode)
+            except OSError as e:
+                self.errors.append("%s: %s" % (e.filename or directory, e.strerror))
+
+        return changed
+
+
+def _fix_permissions(root_dir, args, incremental=False, dirs=None):
+    modes = args.chmodMode.split(":")
+    dir_mode = int(modes[0], 8)
+    file_mode = int(modes[1], 8) if len(modes) > 1 else dir_mode
+
+    uid = gid = -1
+    if args.chown:
+        owner = args.chown.split(":")
+        if owner[0]:
+            uid = pwd.getpwnam(owner[0]).pw_uid
+        if len(owner) > 1 and owner[1]:
+            gid = grp.getgrnam(owner[1]).gr_gid
+
+    since = None
+    stamp = args.read_config("permissions")
+    if incremental and stamp:
+        since = float(stamp)
+
+    started = time.time()
+    fixer = PermissionFixer(dir_mode, file_mode, uid, gid, since)
+    paths = [os.path.join(root_dir, "ow_includes", "config.php")] + \
+        [os.path.join(root_dir, d) for d in (WRITABLE_DIRS if dirs is None else dirs)]
+    changed = sum(_parallel(fixer.fix, paths, args.jobs))
+
+    if fixer.errors:
+        # the stamp stays put, so an incremental run tries these entries again
+        _print("Could not fix permissions of %d entries:\n  %s" % (len(fixer.errors), "\n  ".join(fixer.errors[:10])))
+        return changed
+
+    args.save_config("permissions", started)
+
+    return changed
+
+
+def _copied_in_place(parts):
+    if ".owr" in parts or "vendor" in parts:
+        return True
+
+    if ".git" not in parts:
+        return False
+
+    # packs and loose objects never change once written, the rest of .git does
+    git_parts = parts[len(parts) - parts[::-1].index(".git"):]
+    return len(git_parts) < 2 or git_parts[0] != "objects" or not (git_parts[1] == "pack" or len(git_parts[1]) == 2)
+
+
+def _seed_release(source, target, skip=()):
+    # git replaces working tree files instead of writing into them, so they are hardlinked;
+    # git metadata, owr state, composer.json, composer.lock and vendor folders are written in place and get copied
+    for directory, dirs, files in os.walk(source):
+        relative = os.path.relpath(directory, source)
+        parts = [] if relative == "." else relative.split(os.sep)
+        target_dir = os.path.join(target, *parts)
+        os.makedirs(target_dir)
+        os.chmod(target_dir, stat.S_IMODE(os.stat(directory).st_mode))
+
+        copy = _copied_in_place(parts)
+        for name in dirs + files:
+            path = os.path.join(directory, name)
+            target_path = os.path.join(target_dir, name)
+            if os.path.join(*(parts + [name])) in skip:
+                continue
+
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target_path)
+            elif name in dirs:
+                continue
+            elif copy or name in ("composer.json", "composer.lock"):
+                shutil.copy2(path, target_path)
+            else:
+                try:
+                    os.link(path, target_path)
+                except OSError:
+                    shutil.copy2(path, target_path)
+
+        dirs[:] = [d for d in dirs if os.path.join(*(parts + [d])) not in skip and
+                   not os.path.islink(os.path.join(directory, d))]
 
 
 def _log_operation(operation, repo_url, path, branch):
@@ -69,9 +1097,151 @@ def _log_operation(operation, repo_url, path, branch):
     )
 
     if operation == "update":
-        print "Updating %s (%s) in %s" % args
+        _print("Updating %s (%s) in %s" % args)
     elif operation == "clone":
-        print "Cloning %s (%s) to %s" % args
+        _print("Cloning %s (%s) to %s" % args)
+    elif operation == "bundle":
+        _print("Bundling %s (%s) for %s" % args)
+    elif operation == "migrate":
+        _print("Migrating %s (%s) from %s" % args)
+
+
+class ObjectCache:
+    def __init__(self, path, max_size, borrowed=False):
+        self.path = path
+        self.max_size = max_size
+        self.borrowed = borrowed
+        self._used = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _mirror_path(self, url):
+        # credentials are not part of the key, so every user shares one mirror per repository
+        key = _strip_auth(url)
+        name = re.sub("[^\w.-]", "_", key[key.rstrip("/").rindex("/") + 1:])
+
+        return os.path.join(self.path, "%s-%s" % (hashlib.sha1(key).hexdigest()[:12], name))
+
+    def _mirror_lock(self, path):
+        with self._lock:
+            if path not in self._locks:
+                self._locks[path] = threading.Lock()
+            return self._locks[path]
+
+    def mirror(self, url, max_age=0):
+        path = self._mirror_path(url)
+        stamp = os.path.join(path, "owr-fetched")
+
+        with self._mirror_lock(path):
+            if path in self._used:
+                return path
+
+            # sites borrow objects from these mirrors without copies, nothing they use may ever be pruned
+            keep = ["-c", "gc.auto=0", "-c", "maintenance.auto=false"] if self.borrowed else []
+
+            if os.path.isdir(path):
+                code = 0
+                if not os.path.isfile(stamp) or time.time() - os.path.getmtime(stamp) >= max_age:
+                    code = _runner.execute(["git"] + keep + ["--git-dir=%s" % path, "fetch", "--quiet"] +
+                                           ([] if self.borrowed else ["--prune"]) + ["origin"])[0]
+            else:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                code = _runner.execute(["git", "clone", "--quiet", "--mirror"] +
+                                       (["--config", "gc.auto=0"] if self.borrowed else []) + [url, path])[0]
+
+            if code != 0 and not os.path.isdir(path):
+                return None
+
+            if code == 0:
+                with open(stamp, "w"):
+                    pass
+
+            os.utime(path, None)
+            self._used.add(path)
+
+        return path
+
+    def evict(self):
+        if not os.path.isdir(self.path):
+            return
+
+        mirrors = []
+        total = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            size = 0
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    try:
+                        size += os.lstat(os.path.join(root, f)).st_size
+                    except OSError:
+                        pass
+            mirrors.append((os.path.getmtime(path), size, path))
+            total += size
+
+        # least recently used first; mirrors used by the current run are never evicted
+        for mtime, size, path in sorted(mirrors):
+            if total <= self.max_size:
+                break
+            if path in self._used:
+                continue
+            shutil.rmtree(path, True)
+            total -= size
+
+    def reset(self):
+        # a long running process starts a new run, mirrors are fetched again once they are older than max_age
+        self._used = set()
+
+
+class Workspace:
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        self.repos = ObjectCache(os.path.join(path, "repos"), None, True)
+        self.files = os.path.join(path, "files")
+
+    def mirror(self, url):
+        # sites built within max_age seconds of each other share one network fetch per repository
+        return self.repos.mirror(url, self.max_age)
+
+    def link(self, directory):
+        git = ["--git-dir=%s" % os.path.join(directory, ".git"), "--work-tree=%s" % directory]
+
+        index = _git_output(*(git + ["ls-files", "-s", "-z"]))
+        modified = _git_output(*(git + ["ls-files", "-m", "-z"]))
+        if index is None or modified is None:
+            return 0
+
+        modified = set(modified.split("\0"))
+
+        linked = 0
+        for entry in index.split("\0"):
+            if not entry:
+                continue
+
+            info, path = entry.split("\t", 1)
+            mode, sha = info.split(" ")[:2]
+            if mode not in ("100644", "100755") or path in modified:
+                continue
+
+            file_path = os.path.join(directory, path)
+            stored_path = os.path.join(self.files, sha[:2], "%s-%s" % (sha, mode))
+            try:
+                if not os.path.exists(stored_path):
+                    if not os.path.isdir(os.path.dirname(stored_path)):
+                        os.makedirs(os.path.dirname(stored_path))
+                    os.link(file_path, stored_path)
+                elif not os.path.samefile(file_path, stored_path):
+                    # git replaces files instead of writing into them, so a checkout never leaks into other sites
+                    tmp_path = "%s.owr-link" % file_path
+                    os.link(stored_path, tmp_path)
+                    os.rename(tmp_path, file_path)
+                    linked += 1
+            except OSError:
+                continue
+
+        return linked
 
 
 class SourceListParser:
@@ -79,40 +1249,47 @@ class SourceListParser:
 
     _defaultConfig = ["github.com/oxwall"]
 
-    _repoSection = {
-        "name": "plugins",
-        "prefix": None
-    }
-
-    records = {}
-
     def __init__(self, arguments):
         self._arguments = arguments
-        self._repoSection["config"] = self._defaultConfig
+        self._repoSection = {"name": "plugins", "config": self._defaultConfig}
+        self._prefetched = {}
+        self.records = {}
+        self.profiles = {}
+        self.lists = []
+        self.errors = []
+
+        self._headers = {}
+        if arguments.username:
+            credentials = base64.b64encode('%s:%s' % (arguments.username, arguments.password))
+            self._headers["Authorization"] = "Basic %s" % credentials
+
+    def _include_location(self, source, base_path):
+        if self._arguments.sourceType == "file" and _is_file(source):
+            path = source
+            if _is_relative_path(source):
+                path = os.path.normpath(os.path.join(base_path, source))
+
+            return path, "file"
+
+        if _is_absolute_url(source):
+            url = source
+        elif _is_relative_url(source):
+            url = "%s/%s" % (base_path.rstrip("/"), source)
+        else:
+            url = "%s/%s" % (SOURCE_URL_PREFIX.rstrip("/"), source)
+
+        return url, "url"
 
     def _process_operation(self, command, base_path):
         parts = map(str.strip, command.split(" "))
 
-        g_source_type = self._arguments.sourceType
-
         def include(source):
-            if g_source_type == "file" and _is_file(source):
-                path = source
-                if _is_relative_path(source):
-                    path = os.path.normpath(os.path.join(base_path, source))
+            return self._fetch_source(*self._include_location(source, base_path))
 
-                return self._fetch_source(path, "file")
+        def sparse(name, *dirs):
+            self.profiles[name] = list(dirs)
 
-            if _is_absolute_url(source):
-                url = source
-            elif _is_relative_url(source):
-                url = "%s/%s" % (base_path.rstrip("/"), source)
-            else:
-                url = "%s/%s" % (SOURCE_URL_PREFIX.rstrip("/"), source)
-
-            return self._fetch_source(url, "url")
-
-        operations = {"include": include}
+        operations = {"include": include, "sparse": sparse}
 
         try:
             operation = operations[parts[0]]
@@ -122,13 +1299,22 @@ class SourceListParser:
             return
 
     def _process_section(self, section):
-        parts = map(str.strip, section.split(" "))
+        parts = filter(None, map(str.strip, section.split(" ")))
         self._repoSection["name"] = parts[0]
         if self._arguments.ssh:
-            parts[1] = parts[1].replace('/', ':')
+            # the first prefix is the repository host, the rest are mirrors tried in order when it fails
+            parts[1:] = [p if "=" in p else p.replace('/', ':', 1) for p in parts[1:]]
         self._repoSection["config"] = parts[1:] if len(parts) > 1 else self._defaultConfig
 
-    def _process_line(self, line):
+    def _process_line(self, line, source):
+        options = dict(p.split("=", 1) for p in self._repoSection["config"][1:] if "=" in p)
+
+        # record options are a [key=value ...] suffix and override the section ones
+        match = re.search("\[([^\]]*)\]$", line)
+        if match:
+            options.update(p.split("=", 1) for p in match.group(1).split() if "=" in p)
+            line = line[:match.start()]
+
         parts = map(str.strip, line.split("="))
 
         name = parts[0]
@@ -151,38 +1337,191 @@ class SourceListParser:
 
         self.records[self._repoSection["name"]][name] = {
             "name": name.strip(), "alias": alias.strip(), "branch": branch.strip(),
-            "config": self._repoSection["config"]
+            "config": self._repoSection["config"], "source": source, "sparse": options.get("sparse")
         }
 
     def fetch(self):
-        return self._fetch_source(self._arguments.source, self._arguments.sourceType)
+        records = self._read_index()
+        if records is not None:
+            return records
 
-    def _fetch_source(self, source, source_type):
-        data = []
-        if source_type == "url":
-            request = urllib2.Request(source)
+        records = self._fetch_source(self._arguments.source, self._arguments.sourceType)
+        if records is None:
+            sys.exit(1)
+
+        if not self.errors:
+            self._write_index()
+
+        return records
+
+    def _index_path(self):
+        key = "%s\n%s" % (self._arguments.source, self._arguments.ssh)
+        return os.path.join(SOURCES_CACHE_DIR, "index", "%s.json" % hashlib.sha1(key).hexdigest())
+
+    def _hash(self, lines):
+        return hashlib.sha1("\n".join(lines)).hexdigest()
+
+    def _read_index(self):
+        try:
+            with open(self._index_path()) as f:
+                index = _to_str(json.load(f))
+        except (IOError, ValueError):
+            return None
 
-            if self._arguments.username:
-                base64string = base64.encodestring('%s:%s' % (self._arguments.username, self._arguments.password))[:-1]
-                request.add_header("Authorization", "Basic %s" % base64string)
+        locations = [(source, source_type) for source, source_type, digest in index["lists"]]
 
+        def read(location):
             try:
-                data = urllib2.urlopen(request)
-            except urllib2.HTTPError:
-                print "error: Source list not found: (%s)!!!" % source
-                exit()
+                return self._read_source(*location)
+            except (urllib2.URLError, IOError):
+                return None
+
+        # every list is read anyway, so on a miss they are parsed from what was just read
+        valid = True
+        for location, digest, result in zip(locations, [l[2] for l in index["lists"]],
+                                            _parallel(read, locations, len(locations))):
+            if result is None or self._hash(result[0]) != digest:
+                valid = False
+            if result is not None:
+                self._prefetched[location] = result
+
+        if not valid:
+            return None
+
+        self._prefetched = {}
+        self.lists = index["lists"]
+        self.records = index["records"]
+        self.profiles = index["profiles"]
+
+        return self.records
+
+    def _write_index(self):
+        path = self._index_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        tmp_path = "%s.%d" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"lists": self.lists, "records": self.records, "profiles": self.profiles}, f)
+        os.rename(tmp_path, path)
+
+    def _cache_path(self, url):
+        return os.path.join(SOURCES_CACHE_DIR, hashlib.sha1(url).hexdigest())
+
+    def _read_cache(self, url):
+        path = self._cache_path(url)
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            with open(path) as f:
+                data = f.read()
+        except (IOError, ValueError):
+            return None, None
+
+        return data, meta
+
+    def _write_cache(self, url, data, etag, last_modified):
+        if not os.path.isdir(SOURCES_CACHE_DIR):
+            os.makedirs(SOURCES_CACHE_DIR)
 
+        path = self._cache_path(url)
+        with open(path, "w") as f:
+            f.write(data)
+        with open(path + ".json", "w") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "fetched": time.time()}, f)
+
+    def _read_url(self, url):
+        cached, meta = self._read_cache(url)
+        if cached is not None and time.time() - meta["fetched"] < self._arguments.sourceMaxAge:
+            return cached
+
+        headers = dict(self._headers)
+        if cached is not None:
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["last_modified"]:
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            response = _urlopen(url, headers)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or cached is None:
+                raise
+
+            self._write_cache(url, cached, meta["etag"], meta["last_modified"])
+            return cached
+        except urllib2.URLError as e:
+            if cached is None:
+                raise
+
+            # a stale list is better than no build at all
+            print "warning: using cached source list for %s (%s)" % (url, e)
+            return cached
+
+        data = response.read()
+        _timings.transferred(len(data))
+        self._write_cache(url, data, response.info().get("ETag"), response.info().get("Last-Modified"))
+
+        return data
+
+    def _read_source(self, source, source_type):
+        with _timings.phase("source", source):
+            return self._read_source_data(source, source_type)
+
+    def _read_source_data(self, source, source_type):
+        if source_type == "url":
+            data = self._read_url(source)
             base_path = source[0:source.rindex("/")] + "/"
         else:
+            with open(source) as f:
+                data = f.read()
+            base_path = os.path.dirname(source)
+
+        return data.splitlines(), base_path
+
+    def _prefetch_includes(self, lines, base_path):
+        locations = []
+        for line in lines:
+            line = line.strip()
+            if line.startswith("<") and line.endswith(">"):
+                parts = line[1:-1].strip().split()
+                if len(parts) == 2 and parts[0] == "include":
+                    location = self._include_location(parts[1], base_path)
+                    if location not in self._prefetched and location not in locations:
+                        locations.append(location)
+
+        def read(location):
             try:
-                data = open(source)
-            except IOError:
-                print "error: Could not open source list: (%s)!!!" % source
-                exit()
+                return self._read_source(*location)
+            except (urllib2.URLError, IOError):
+                # errors are reported when the include is actually processed
+                return None
 
-            base_path = os.path.dirname(source)
+        # sibling includes are fetched concurrently, but still processed in the order they are listed
+        for location, result in zip(locations, _parallel(read, locations, len(locations))):
+            if result is not None:
+                self._prefetched[location] = result
+
+    def _fetch_source(self, source, source_type):
+        try:
+            lines, base_path = self._prefetched.pop((source, source_type))
+        except KeyError:
+            try:
+                lines, base_path = self._read_source(source, source_type)
+            except (urllib2.URLError, IOError):
+                if source_type == "url":
+                    print "error: Source list not found: (%s)!!!" % source
+                else:
+                    print "error: Could not open source list: (%s)!!!" % source
+
+                # a missing include is reported as a failure, the rest of the build goes on
+                self.errors.append((source, "Source list not found"))
+                return None
 
-        for line in data:
+        self.lists.append([source, source_type, self._hash(lines)])
+        self._prefetch_includes(lines, base_path)
+
+        for line in lines:
             line = line.strip()
             if line and not line.startswith("#"):
                 if line.startswith("[") and line.endswith("]"):
@@ -190,7 +1529,7 @@ class SourceListParser:
                 elif line.startswith("<") and line.endswith(">"):
                     self._process_operation(line[1:-1].strip(), base_path)
                 else:
-                    self._process_line(line)
+                    self._process_line(line, source)
 
         return self.records
 
@@ -210,6 +1549,42 @@ class Arguments:
     verbose = False
     clearChanges = False
     disableChmod = False
+    jobs = 1
+    cache = False
+    cacheDir = CACHE_DIR
+    cacheSize = 2048
+    objectCache = None
+    workspaceDir = None
+    workspaceMaxAge = 300
+    workspace = None
+    depth = None
+    filter = None
+    skipUnchanged = False
+    sourceMaxAge = 0
+    fromLock = False
+    fromBundle = False
+    changesHook = None
+    retries = 3
+    retryDelay = 1.0
+    progress = None
+    proxy = None
+    noFetch = False
+    interval = 300
+    hostJobs = 4
+    timings = None
+    timingsFile = None
+    maxProcesses = 16
+    timeout = 600
+    sshCommand = None
+    archive = False
+    archiveUrl = ARCHIVE_URL
+    chmodMode = "777"
+    chown = None
+    chmodIncremental = False
+    ffOnly = False
+    keep = 5
+    rollback = False
+    shared = "ow_userfiles,ow_pluginfiles,ow_log,ow_includes/config.php"
 
     runDir = None
 
@@ -223,6 +1598,12 @@ class Arguments:
     def parse(self):
         self.parse_args()
 
+        if self.cache:
+            self.objectCache = ObjectCache(os.path.expanduser(self.cacheDir), self.cacheSize * 1024 * 1024)
+
+        if self.workspaceDir:
+            self.workspace = Workspace(os.path.abspath(os.path.expanduser(self.workspaceDir)), self.workspaceMaxAge)
+
     def parse_args(self):
         parser = argparse.ArgumentParser()
 
@@ -256,44 +1637,306 @@ class Arguments:
                             action="store_true",
                             default=self.requirePassword,
                             required=False,
-                            help="Pass this flag if password authorization is required")
+                            help="Pass this flag if password authorization is required")
+
+        parser.add_argument('--password',
+                            dest="passwordString",
+                            default=self.passwordString,
+                            required=False,
+                            help="Password string")
+
+        parser.add_argument('--ssh',
+                            dest="ssh",
+                            action="store_true",
+                            default=self.ssh,
+                            required=False,
+                            help="Use ssh")
+
+        parser.add_argument('--ssh-command',
+                            dest="sshCommand",
+                            default=self.sshCommand,
+                            required=False,
+                            help="Ssh client for --ssh (default: $GIT_SSH_COMMAND or ssh), one multiplexed master "
+                                 "connection per host is kept open for the whole run")
+
+        parser.add_argument('-v', '--verbose',
+                            dest="verbose",
+                            action="store_true",
+                            default=self.verbose,
+                            required=False,
+                            help="Pass this flag if you want more verbose output")
+
+        parser.add_argument('-c', '--clear-changes',
+                            dest="clearChanges",
+                            action="store_true",
+                            default=self.clearChanges,
+                            required=False,
+                            help="Pass this flag if you want to clear all changes you made. Cannot be undone!!!")
+
+        parser.add_argument('--ff-only',
+                            dest="ffOnly",
+                            action="store_true",
+                            default=self.ffOnly,
+                            required=False,
+                            help="Only fast-forward master on update, local commits and changes are left alone")
+
+        parser.add_argument('--disable-chmod',
+                            dest="disableChmod",
+                            action="store_true",
+                            default=self.disableChmod,
+                            required=False,
+                            help="Pass this flag if you want to disable chmod!!!")
+
+        parser.add_argument('--chmod-mode',
+                            dest="chmodMode",
+                            type=self._chmod_mode,
+                            default=self.chmodMode,
+                            required=False,
+                            help="Octal mode for writable folders, DIR_MODE[:FILE_MODE] (default: %(default)s)")
+
+        parser.add_argument('--chown',
+                            dest="chown",
+                            type=self._chown,
+                            default=self.chown,
+                            required=False,
+                            help="USER[:GROUP] owning the writable folders")
+
+        parser.add_argument('--chmod-incremental',
+                            dest="chmodIncremental",
+                            action="store_true",
+                            default=self.chmodIncremental,
+                            required=False,
+                            help="Fix permissions on update too, only for entries added since the last run")
+
+        parser.add_argument('-j', '--jobs',
+                            dest="jobs",
+                            type=int,
+                            default=self.jobs,
+                            required=False,
+                            help="Number of plugin and theme repositories processed at the same time")
+
+        parser.add_argument('--cache',
+                            dest="cache",
+                            action="store_true",
+                            default=self.cache,
+                            required=False,
+                            help="Borrow objects from a local cache of bare mirrors when cloning")
+
+        parser.add_argument('--cache-dir',
+                            dest="cacheDir",
+                            default=self.cacheDir,
+                            required=False,
+                            help="Object cache folder (default: %(default)s)")
+
+        parser.add_argument('--cache-size',
+                            dest="cacheSize",
+                            type=int,
+                            default=self.cacheSize,
+                            required=False,
+                            help="Object cache size limit in megabytes, least recently used mirrors are evicted first")
+
+        parser.add_argument('--workspace',
+                            dest="workspaceDir",
+                            default=self.workspaceDir,
+                            required=False,
+                            help="Shared workspace folder for many sites: git objects are borrowed from one mirror per "
+                                 "repository and unchanged files are hardlinked between sites. Files must not be "
+                                 "edited in place!!! Sites depend on the mirrors: never gc, prune or delete them")
+
+        parser.add_argument('--workspace-max-age',
+                            dest="workspaceMaxAge",
+                            type=int,
+                            default=self.workspaceMaxAge,
+                            required=False,
+                            help="Reuse workspace mirrors fetched less than the given number of seconds ago")
+
+        parser.add_argument('--depth',
+                            dest="depth",
+                            type=int,
+                            default=self.depth,
+                            required=False,
+                            help="Create shallow clones with a history truncated to the given number of commits")
+
+        parser.add_argument('--filter',
+                            dest="filter",
+                            default=self.filter,
+                            required=False,
+                            help="Create partial clones with the given object filter (e.g. blob:none)")
+
+        parser.add_argument('--skip-unchanged',
+                            dest="skipUnchanged",
+                            action="store_true",
+                            default=self.skipUnchanged,
+                            required=False,
+                            help="Compare remote heads first and update only the repositories that are behind")
+
+        parser.add_argument('--source-max-age',
+                            dest="sourceMaxAge",
+                            type=int,
+                            default=self.sourceMaxAge,
+                            required=False,
+                            help="Use cached source lists younger than the given number of seconds without revalidation")
+
+        parser.add_argument('--from-lock',
+                            dest="fromLock",
+                            action="store_true",
+                            default=self.fromLock,
+                            required=False,
+                            help="Treat the source as a lock file (.owr/lock.json) and check out exactly the locked commits")
+
+        parser.add_argument('--changes-hook',
+                            dest="changesHook",
+                            default=self.changesHook,
+                            required=False,
+                            help="Command to run after update, gets the path of .owr/changes.json as the last argument")
+
+        parser.add_argument('--from-bundle',
+                            dest="fromBundle",
+                            action="store_true",
+                            default=self.fromBundle,
+                            required=False,
+                            help="Treat the source as an archive made by the bundle command and clone without network")
+
+        parser.add_argument('--timings',
+                            dest="timings",
+                            choices=["text", "json"],
+                            default=self.timings,
+                            required=False,
+                            help="Print a per-repository and per-phase timing report when the command is done")
+
+        parser.add_argument('--timings-file',
+                            dest="timingsFile",
+                            default=self.timingsFile,
+                            required=False,
+                            help="Write the timing report to the given file instead of standard output")
+
+        parser.add_argument('--max-processes',
+                            dest="maxProcesses",
+                            type=int,
+                            default=self.maxProcesses,
+                            required=False,
+                            help="Maximum number of git and composer processes running at the same time")
+
+        parser.add_argument('--timeout',
+                            dest="timeout",
+                            type=int,
+                            default=self.timeout,
+                            required=False,
+                            help="Kill a git or composer process after the given number of seconds, 0 disables")
+
+        parser.add_argument('--progress',
+                            dest="progress",
+                            choices=["plain", "json"],
+                            default=self.progress,
+                            required=False,
+                            help="Report repositories done, throughput and the slowest running ones on stderr")
+
+        parser.add_argument('--proxy',
+                            dest="proxy",
+                            default=self.proxy,
+                            required=False,
+                            help="Proxy for source list and composer downloads, defaults to http_proxy/https_proxy")
+
+        parser.add_argument('--no-fetch',
+                            dest="noFetch",
+                            action="store_true",
+                            default=self.noFetch,
+                            required=False,
+                            help="Update from already fetched remote branches only (see the agent command)")
+
+        parser.add_argument('--interval',
+                            dest="interval",
+                            type=int,
+                            default=self.interval,
+                            required=False,
+                            help="Seconds between fetch rounds of the agent command, 0 runs a single round")
+
+        parser.add_argument('--host-jobs',
+                            dest="hostJobs",
+                            type=int,
+                            default=self.hostJobs,
+                            required=False,
+                            help="Maximum number of concurrent fetches from one host in the agent command")
+
+        parser.add_argument('--retries',
+                            dest="retries",
+                            type=int,
+                            default=self.retries,
+                            required=False,
+                            help="Number of times a failed clone, fetch or download is retried")
 
-        parser.add_argument('--password',
-                            dest="passwordString",
-                            default=self.passwordString,
+        parser.add_argument('--retry-delay',
+                            dest="retryDelay",
+                            type=float,
+                            default=self.retryDelay,
                             required=False,
-                            help="Password string")
+                            help="Base delay in seconds for the exponential backoff between retries")
 
-        parser.add_argument('--ssh',
-                            dest="ssh",
+        parser.add_argument('--archive',
+                            dest="archive",
                             action="store_true",
-                            default=self.ssh,
+                            default=self.archive,
                             required=False,
-                            help="Use ssh")
+                            help="Clone without git: download every repository as a tarball of its branch or locked "
+                                 "commit, the commit is kept in .owr-archive")
 
-        parser.add_argument('-v', '--verbose',
-                            dest="verbose",
-                            action="store_true",
-                            default=self.verbose,
+        parser.add_argument('--archive-url',
+                            dest="archiveUrl",
+                            default=self.archiveUrl,
                             required=False,
-                            help="Pass this flag if you want more verbose output")
+                            help="Base url of the tarball host for --archive (default: %(default)s)")
 
-        parser.add_argument('-c', '--clear-changes',
-                            dest="clearChanges",
-                            action="store_true",
-                            default=self.clearChanges,
+        parser.add_argument('--keep',
+                            dest="keep",
+                            type=int,
+                            default=self.keep,
                             required=False,
-                            help="Pass this flag if you want to clear all changes you made. Cannot be undone!!!")
+                            help="Number of previous releases the deploy command keeps for rollback")
 
-        parser.add_argument('--disable-chmod',
-                            dest="disableChmod",
+        parser.add_argument('--rollback',
+                            dest="rollback",
                             action="store_true",
-                            default=self.disableChmod,
+                            default=self.rollback,
                             required=False,
-                            help="Pass this flag if you want to disable chmod!!!")
+                            help="Switch the current symlink of a deploy root back to the previous release")
+
+        parser.add_argument('--shared',
+                            dest="shared",
+                            default=self.shared,
+                            required=False,
+                            help="Comma separated paths kept in the shared folder of a deploy root and linked into "
+                                 "every release (default: %(default)s)")
 
         parser.parse_args(namespace=self)
 
+        if self.ffOnly and self.depth:
+            # a shallow update moves master to the fetched commit, local commits could not be kept
+            parser.error("--ff-only cannot be combined with --depth")
+
+    def _chmod_mode(self, mode):
+        modes = mode.split(":")
+        if len(modes) > 2 or not all(re.match("^[0-7]{1,4}$", m) for m in modes):
+            raise argparse.ArgumentTypeError("Invalid mode: %s" % mode)
+
+        return mode
+
+    def _chown(self, owner):
+        # checked up front, not after every repository was cloned
+        names = owner.split(":")
+        try:
+            if names[0]:
+                pwd.getpwnam(names[0])
+        except KeyError:
+            raise argparse.ArgumentTypeError("Unknown user: %s" % names[0])
+
+        try:
+            if len(names) > 1 and names[1]:
+                grp.getgrnam(names[1])
+        except KeyError:
+            raise argparse.ArgumentTypeError("Unknown group: %s" % names[1])
+
+        return owner
+
     def _path(self, path):
         command = self._commands[self.command]
 
@@ -322,18 +1965,7 @@ class Arguments:
         if not _is_absolute_url(source):
             source = "%s/%s" % (self._sourcesUrlPrefix, source)
 
-        try:
-            request = urllib2.Request(source)
-
-            if self.username:
-                base64string = base64.encodestring('%s:%s' % (self.username, self.password))[:-1]
-                request.add_header("Authorization", "Basic %s" % base64string)
-
-            request.get_method = lambda: 'HEAD'
-            urllib2.urlopen(request)
-        except:
-            raise argparse.ArgumentTypeError('Source list not found')
-
+        # availability is checked when the list is fetched, no separate HEAD request
         return source
 
     def read_config(self, name):
@@ -379,58 +2011,128 @@ class Arguments:
     def save_configs(self):
         self.save_config("username", self.username if self.username else "")
         self.save_config("require-password", 1 if self.requirePassword else 0)
-        self.save_config("source", self.source if self.source else "")
+        if not self.fromLock and not self.fromBundle:
+            self.save_config("source", self.source if self.source else "")
         self.save_config("email", self.email if self.email else "")
 
 
 class Command:
-    composer_tmp_path = ''
+    composer_path = ''
+    parallel = True
+    read_only = False
+    watch = False
 
     def __init__(self, name):
         self.name = name
+        self._composer_lock = threading.Lock()
 
     def validate_path(self, path, args):
         return path
 
+    def prepare(self, args):
+        return True
+
     def fetched(self, sections, args):
         pass
 
-    def main(self, root_dir, url, args, branch):
+    def plan(self, items, args):
+        return items
+
+    def main(self, root_dir, url, args, branch, *opt):
         pass
 
     def item(self, path, url, args, branch, *opt):
         pass
 
-    def composer(self, path):
-        if self.name not in ['update', 'clone'] or not os.path.exists('%s/composer.json' % path):
+    def _composer_phar(self):
+        path = os.path.join(COMPOSER_DIR, "composer.phar")
+        checksum_path = path + ".sha256"
+
+        # the phar is kept between runs and reused as long as its checksum matches
+        if os.path.isfile(path) and os.path.isfile(checksum_path) and \
+                time.time() - os.path.getmtime(path) < COMPOSER_MAX_AGE:
+            with open(checksum_path) as f:
+                if f.read().strip() == _sha256(path):
+                    return path
+
+        if not os.path.isdir(COMPOSER_DIR):
+            os.makedirs(COMPOSER_DIR)
+
+        checksum = _urlopen(COMPOSER_CHECKSUM_URL).read().split()[0]
+
+        download_path = tempfile.mkstemp(dir=COMPOSER_DIR)[1]
+        with open(download_path, 'wb') as output:
+            shutil.copyfileobj(_urlopen(COMPOSER_DOWNLOAD_URL), output)
+        _timings.transferred(os.path.getsize(download_path))
+
+        if _sha256(download_path) != checksum:
+            os.remove(download_path)
+            raise IOError("composer.phar checksum mismatch")
+
+        os.rename(download_path, path)
+        with open(checksum_path, "w") as f:
+            f.write(checksum)
+
+        return path
+
+    def _composer_state(self, path):
+        digest = hashlib.sha1()
+        for name in ("composer.json", "composer.lock"):
+            file_path = os.path.join(path, name)
+            if os.path.isfile(file_path):
+                with open(file_path, "rb") as f:
+                    digest.update(f.read())
+
+        return digest.hexdigest()
+
+    def composer(self, path, changed=True):
+        if self.name not in ['update', 'clone', 'deploy'] or not os.path.exists('%s/composer.json' % path):
             return None
 
-        if not self.composer_tmp_path:
-            composer = urllib2.urlopen(COMPOSER_DOWNLOAD_URL)
-            self.composer_tmp_path = tempfile.mkstemp()[1]
-            output = open(self.composer_tmp_path, 'wb')
-            output.write(composer.read())
-            output.close()
+        # nothing to do if neither composer.json nor composer.lock changed since the last successful run
+        state_path = os.path.join(path, "vendor", ".owr-composer")
+        if os.path.isfile(state_path):
+            if not changed:
+                return None
 
-        shutil.copyfile(self.composer_tmp_path, "%s/composer.phar" % path)
-        if os.path.exists('%s/composer.lock' % path):
-            sp = subprocess.Popen('php composer.phar update', shell=True, stdout=subprocess.PIPE, cwd=path)
-        else:
-            sp = subprocess.Popen('php composer.phar install', shell=True, stdout=subprocess.PIPE, cwd=path)
-        result = sp.communicate()[0]
-        print(result)
+            with open(state_path) as f:
+                if f.read() == self._composer_state(path):
+                    return None
+
+        with self._composer_lock:
+            if not self.composer_path:
+                self.composer_path = self._composer_phar()
+
+        operation = "update" if os.path.exists('%s/composer.lock' % path) else "install"
+        env = dict(os.environ, COMPOSER_CACHE_DIR=os.path.join(COMPOSER_DIR, "cache"))
+        if _run(["php", self.composer_path, operation], cwd=path, env=env) != 0:
+            return None
+
+        if not os.path.isdir(os.path.dirname(state_path)):
+            os.makedirs(os.path.dirname(state_path))
+        with open(state_path, "w") as f:
+            f.write(self._composer_state(path))
 
     def clear_temp(self):
-        if self.name in ['update', 'clone']:
-            os.remove(self.composer_tmp_path)
+        pass
+
+    def updated(self, changes, args):
+        pass
+
+    def resolved(self, model, args):
+        pass
 
     def completed(self, root_dir, url, args):
         pass
 
+    def finish(self, root_dir, failures, args):
+        pass
+
 
 class UpdateCommand(Command):
     def __init__(self):
         Command.__init__(self, "update")
+        self._changes = None
 
     def validate_path(self, path, args):
         if not os.path.isdir(os.path.join(path, ".git")):
@@ -438,56 +2140,82 @@ class UpdateCommand(Command):
 
         return path
 
-    def main(self, root_dir, url, args, branch):
-        quiet = ""
-        if not args.verbose:
-            _log_operation("update", url, root_dir, branch)
-            quiet = "--quiet"
+    def _is_up_to_date(self, item, args):
+        git_dir = os.path.join(item['path'], ".git")
+        if not os.path.isdir(git_dir):
+            return False
 
-        abs_path = os.path.abspath(root_dir)
-        os.system(("git --work-tree=%s --git-dir=%s pull " + quiet + " origin master") % (
-            abs_path + os.sep, os.path.join(abs_path, ".git"))
-        )
+        if item.get('commit'):
+            return not args.clearChanges and \
+                _git_output("--git-dir=%s" % git_dir, "rev-parse", "-q", "--verify", "HEAD") == item['commit']
 
-        if args.clearChanges:
-            os.system(("git --work-tree=%s --git-dir=%s checkout " + quiet + " -- .") % (
-                abs_path + os.sep, os.path.join(abs_path, ".git"))
-            )
+        remote = _git_output("ls-remote", item['url'], "refs/heads/%s" % item['branch'])
+        if not remote:
+            return False
 
-        if branch != "master":
-            _change_branch(abs_path, branch, not args.verbose)
+        remote_sha = remote.split()[0]
+        if _git_output("--git-dir=%s" % git_dir, "rev-parse", "-q", "--verify",
+                       "refs/remotes/origin/%s" % item['branch']) != remote_sha:
+            return False
+
+        if _git_output("--git-dir=%s" % git_dir, "rev-parse", "-q", "--verify", "HEAD") != remote_sha:
+            return False
+
+        if args.clearChanges and _git_output("--git-dir=%s" % git_dir, "--work-tree=%s" % item['path'],
+                                             "status", "--porcelain", "--untracked-files=no") != "":
+            return False
+
+        return True
+
+    def plan(self, items, args):
+        if not args.skipUnchanged:
+            return items
+
+        # remote heads are compared in parallel, only repositories that are behind get updated
+        up_to_date = _parallel(lambda item: self._is_up_to_date(item, args), items, max(args.jobs, 8))
+        planned = [item for item, skip in zip(items, up_to_date) if not skip]
 
-    def item(self, path, url, args, branch, create=True, *opt):
-        quiet = ""
+        print "%d of %d repositories are up to date" % (len(items) - len(planned), len(items))
+
+        return planned
+
+    def main(self, root_dir, url, args, branch, sparse=None, *opt):
         if not args.verbose:
-            quiet = "--quiet"
+            _log_operation("update", url, root_dir, branch)
+
+        _update_branch(os.path.abspath(root_dir), url, branch, args, sparse)
 
+    def item(self, path, url, args, branch, create=True, sparse=None, *opt):
         if os.path.isdir(path):
             if not args.verbose:
                 _log_operation("update", url, path, branch)
 
-            if args.clearChanges:
-                os.system(("git --work-tree=%s --git-dir=%s checkout " + quiet + " -- .") % (
-                    path + os.sep, os.path.join(path, ".git"))
-                )
-
-            # Checkout master branch
-            os.system(("git --work-tree=%s --git-dir=%s checkout " + quiet + " master") % (
-                path + os.sep, os.path.join(path, ".git"))
-            )
-
-            # Pull master branch
-            os.system(("git --work-tree=%s --git-dir=%s pull " + quiet + " origin master") % (
-                path + os.sep, os.path.join(path, ".git"))
-            )
+            _update_branch(path, url, branch, args, sparse)
         elif create:
             if not args.verbose:
                 _log_operation("clone", url, path, branch)
 
-            os.system("git clone " + quiet + " %s %s" % (url, path))
+            _clone(url, path, args, branch, *_sparse_options(sparse))
+            _sparse_checkout(path, sparse, args)
 
-        if branch != "master":
-            _change_branch(path, branch, not args.verbose)
+            if branch != "master":
+                _change_branch(path, branch, args)
+
+    def updated(self, changes, args):
+        self._changes = changes
+
+    def completed(self, root_dir, url, args):
+        if args.chmodIncremental and not args.disableChmod and self._changes:
+            # a run without changes is skipped, the stamp stays put so entries added meanwhile are caught next time;
+            # every writable directory is walked, the stamp covers all of them
+            _fix_permissions(root_dir, args, True)
+
+        self._changes_hook(root_dir, args)
+
+    def _changes_hook(self, root_dir, args):
+        if args.changesHook:
+            _run(shlex.split(args.changesHook) + [os.path.abspath(os.path.join(root_dir, ".owr", "changes.json"))],
+                 cwd=os.path.abspath(root_dir))
 
 
 class CloneCommand(Command):
@@ -507,61 +2235,61 @@ class CloneCommand(Command):
 
         return path
 
-    def main(self, root_dir, url, args, branch):
-        quiet = ""
+    def main(self, root_dir, url, args, branch, sparse=None, *opt):
         if not args.verbose:
             _log_operation("clone", url, root_dir, branch)
-            quiet = "--quiet"
 
         if os.path.isdir(root_dir):
 
             tmp_dir = tempfile.mkdtemp()
-
-            os.system(("git clone " + quiet + " --no-checkout %s %s") % (url, tmp_dir))
-            shutil.move(os.path.join(tmp_dir, ".git"), os.path.join(root_dir, ".git"))
-            os.chdir(root_dir)
-            os.system("git reset " + quiet + " --hard HEAD")
-
-            shutil.rmtree(tmp_dir)
+            try:
+                # a failed clone is left to the mirror loop, there is nothing to move
+                if _clone(url, tmp_dir, args, branch, "--no-checkout", *_sparse_options(sparse)) != 0:
+                    return
+
+                shutil.move(os.path.join(tmp_dir, ".git"), os.path.join(root_dir, ".git"))
+                _sparse_checkout(root_dir, sparse, args)
+                _run(_git(root_dir, "reset", *(_quiet(args) + ["--hard", "HEAD"])))
+            finally:
+                shutil.rmtree(tmp_dir, True)
         else:
-            os.system("git clone " + quiet + " %s %s" % (url, root_dir))
+            _clone(url, root_dir, args, branch, *_sparse_options(sparse))
+            _sparse_checkout(root_dir, sparse, args)
 
         if branch != "master":
-            _change_branch(root_dir, branch, not args.verbose)
-
-        os.chdir(args.runDir)
+            _change_branch(root_dir, branch, args)
 
-    def item(self, path, url, args, branch, *opt):
-        quiet = ""
+    def item(self, path, url, args, branch, create=True, sparse=None, *opt):
         if not args.verbose:
             _log_operation("clone", url, path, branch)
-            quiet = "--quiet"
 
-        os.system("git clone " + quiet + " %s %s" % (url, path))
+        _clone(url, path, args, branch, *_sparse_options(sparse))
+        _sparse_checkout(path, sparse, args)
 
         if branch != "master":
-            _change_branch(path, branch, not args.verbose)
+            _change_branch(path, branch, args)
 
     def completed(self, root_dir, url, args):
+        # core failed to clone, there is nothing to configure and the failure report still has to come
+        if not os.path.isfile(os.path.join(root_dir, "ow_includes", "config.php.default")):
+            return
+
         config_file = os.path.join(root_dir, "ow_includes", "config.php")
         shutil.copyfile(os.path.join(root_dir, "ow_includes", "config.php.default"), config_file)
 
         templatec_path = os.path.join(root_dir, "ow_smarty", "template_c")
         if not os.path.isdir(templatec_path):
-            os.mkdir(templatec_path)
+            os.makedirs(templatec_path)
 
         if not args.disableChmod:
-            os.system("chmod 777 %s" % config_file)
-            os.system("chmod -R 777 %s" % os.path.join(root_dir, "ow_userfiles"))
-            os.system("chmod -R 777 %s" % os.path.join(root_dir, "ow_pluginfiles"))
-            os.system("chmod -R 777 %s" % os.path.join(root_dir, "ow_static"))
-            os.system("chmod -R 777 %s" % os.path.join(root_dir, "ow_log"))
-            os.system("chmod -R 777 %s" % templatec_path)
+            _fix_permissions(root_dir, args)
 
 
 class MigrateCommand(Command):
     def __init__(self):
         Command.__init__(self, "migrate")
+        self._results = []
+        self._lock = threading.Lock()
 
     def validate_path(self, path, args):
         if not os.path.isfile(os.path.join(path, "ow_version.xml")):
@@ -569,7 +2297,7 @@ class MigrateCommand(Command):
 
         return path
 
-    def main(self, root_dir, url, args, branch):
+    def main(self, root_dir, url, args, branch, *opt):
         if not args.username:
             print "error: Github user name is required !!!"
             exit()
@@ -578,26 +2306,421 @@ class MigrateCommand(Command):
             print "error: Github user email is required !!!"
             exit()
 
+    def _migrate(self, path, url, args, tmp_dir):
+        env = dict(os.environ)
+        if _output.buffer is not None:
+            env["GIT_TERMINAL_PROMPT"] = "0"
+
+        remote = _git_output("ls-remote", url, "refs/heads/master", env=env)
+        if remote is None:
+            _output.failures.append("git ls-remote %s" % _strip_auth(url))
+            return "failed"
+
+        # the plugin directory is the work tree of a temporary repository, only the last remote commit is fetched
+        git = ["git", "--git-dir=%s" % tmp_dir, "--work-tree=%s" % path]
+        env = dict(env, GIT_INDEX_FILE=os.path.join(tmp_dir, "owr-index"),
+                   GIT_AUTHOR_NAME=args.username, GIT_AUTHOR_EMAIL=args.email,
+                   GIT_COMMITTER_NAME=args.username, GIT_COMMITTER_EMAIL=args.email)
+
+        _run(["git", "init", "--quiet", "--bare", tmp_dir])
+
+        parent = remote.split()[0] if remote else None
+        if parent:
+            if _run(git + ["fetch", "--quiet", "--depth", "1", url, "+refs/heads/master:refs/heads/master"],
+                    retry=True) != 0:
+                return "failed"
+            _run(git + ["read-tree", parent], env=env)
+
+        # like copying the files over a clone, nothing is removed from the remote tree
+        _run(git + ["add", "--ignore-removal", "."], cwd=path, env=env)
+
+        tree = _git_output(*(git[1:] + ["write-tree"]), env=env)
+        if not tree:
+            _output.failures.append("git write-tree")
+            return "failed"
+
+        if parent and _git_output(*(git[1:] + ["rev-parse", "%s^{tree}" % parent])) == tree:
+            return "up to date"
+
+        parents = ["-p", parent] if parent else []
+        commit = _git_output(*(git[1:] + ["commit-tree", tree, "-m", "Source code"] + parents), env=env)
+        if not commit:
+            _output.failures.append("git commit-tree")
+            return "failed"
+
+        if _run(git + ["push", "--quiet", url, "%s:refs/heads/master" % commit], retry=True) != 0:
+            return "failed"
+
+        return "migrated"
+
     def item(self, path, url, args, *opt):
         if not os.path.isdir(path):
             return
 
+        if not args.verbose:
+            _log_operation("migrate", url, path, "master")
+
         tmp_dir = tempfile.mkdtemp()
+        try:
+            result = self._migrate(path, url, args, tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir, True)
+
+        with self._lock:
+            self._results.append((os.path.relpath(path, os.path.abspath(args.path)), result))
+
+    def completed(self, root_dir, url, args):
+        counts = {}
+        for path, result in sorted(self._results):
+            counts[result] = counts.get(result, 0) + 1
+            print "%-12s %s" % (result, path)
+
+        print "\n%d migrated, %d up to date, %d failed" % (counts.get("migrated", 0), counts.get("up to date", 0),
+                                                         counts.get("failed", 0))
+
+
+class BundleCommand(Command):
+    def __init__(self):
+        Command.__init__(self, "bundle")
+        self._staging = None
+        self._repositories = []
+        self._lock = threading.Lock()
+
+    def validate_path(self, path, args):
+        if os.path.isdir(path):
+            raise argparse.ArgumentTypeError('Bundle path should be a file')
+
+        return path
+
+    def fetched(self, sections, args):
+        self._staging = tempfile.mkdtemp()
+
+    def main(self, root_dir, url, args, branch, *opt):
+        self.item(root_dir, url, args, branch)
+
+    def item(self, path, url, args, branch, *opt):
+        relative_path = os.path.relpath(path, os.path.abspath(args.path))
+        if not args.verbose:
+            _log_operation("bundle", url, relative_path, branch)
+
+        with self._lock:
+            index = len(self._repositories)
+            self._repositories.append(None)
+
+        mirror_dir = os.path.join(self._staging, "mirrors", str(index))
+        bundle = os.path.join("bundles", str(index), url[url.rindex("/") + 1:])
+        os.makedirs(os.path.dirname(os.path.join(self._staging, bundle)))
+
+        source = url
+        if args.objectCache:
+            source = args.objectCache.mirror(url) or url
+
+        try:
+            if _run(["git", "clone"] + _quiet(args) + ["--mirror", source, mirror_dir], retry=True) != 0:
+                return
 
-        os.chdir(tmp_dir)
+            if _run(["git", "--git-dir=%s" % mirror_dir, "bundle", "create"] + _quiet(args) +
+                    [os.path.join(self._staging, bundle), "--all"]) != 0:
+                return
 
-        os.system("git clone %s %s" % (url, tmp_dir))
-        os.system("git config user.email %s" % args.email)
-        os.system("git config user.name %s" % args.username)
+            commit = _git_output("--git-dir=%s" % mirror_dir, "rev-parse", "-q", "--verify",
+                                 "refs/heads/%s^{commit}" % branch)
+        finally:
+            shutil.rmtree(mirror_dir, True)
 
-        os.system("cp -r %s %s" % (os.path.join(path, "*"), tmp_dir + os.sep))
+        self._repositories[index] = {"path": relative_path, "url": _strip_auth(url), "branch": branch,
+                                     "commit": commit, "bundle": bundle}
 
-        os.system("git add .")
-        os.system('git ci -m "Source code"')
-        os.system("git push -u origin master")
+    def completed(self, root_dir, url, args):
+        # same format as .owr/lock.json, so a bundle restores exactly the commits it was made from
+        with open(os.path.join(self._staging, "lock.json"), "w") as f:
+            json.dump({"source": _strip_auth(args.source), "repositories": filter(None, self._repositories)}, f,
+                      indent=4, sort_keys=True)
+
+        tmp_path = "%s.tmp" % args.path
+        with tarfile.open(tmp_path, "w") as archive:
+            archive.add(os.path.join(self._staging, "lock.json"), "lock.json")
+            archive.add(os.path.join(self._staging, "bundles"), "bundles")
+        os.rename(tmp_path, args.path)
+
+        shutil.rmtree(self._staging, True)
+
+
+class ResolveCommand(Command):
+    read_only = True
+
+    def __init__(self):
+        Command.__init__(self, "resolve")
+
+    def resolved(self, model, args):
+        root_dir = os.path.abspath(args.path)
+        repositories = [{"path": os.path.relpath(item['path'], root_dir),
+                         "url": _strip_auth(item.get('origin', item['url'])),
+                         "branch": item['branch'],
+                         "commit": item.get('commit'),
+                         "mirrors": item.get('mirrors', []),
+                         "sparse": item.get('sparse'),
+                         "source": item.get('source')} for item in model["repositories"]]
+
+        print json.dumps({"source": model["source"], "lists": model["lists"], "repositories": repositories},
+                         indent=4, sort_keys=True)
+
+
+class PlanCommand(Command):
+    read_only = True
+
+    def __init__(self):
+        Command.__init__(self, "plan")
+
+    def _head(self, git_dir):
+        try:
+            with open(os.path.join(git_dir, "HEAD")) as f:
+                head = f.read().strip()
+            if not head.startswith("ref: "):
+                return head
+
+            ref = head[len("ref: "):]
+            if os.path.isfile(os.path.join(git_dir, ref)):
+                with open(os.path.join(git_dir, ref)) as f:
+                    return f.read().strip()
+
+            with open(os.path.join(git_dir, "packed-refs")) as f:
+                for line in f:
+                    if line.rstrip("\n").endswith(" " + ref):
+                        return line.split(" ")[0]
+        except IOError:
+            pass
+
+        return None
+
+    def resolved(self, model, args):
+        root_dir = os.path.abspath(args.path)
+
+        # nothing but the file system is looked at, a site without core git repository would be cloned
+        cloning = not os.path.isdir(os.path.join(root_dir, ".git"))
+
+        counts = {}
+        for item in model["repositories"]:
+            git_dir = os.path.join(item['path'], ".git")
+            target = item.get('commit') or item['branch']
+
+            if cloning or not os.path.isdir(git_dir):
+                action = "clone" if cloning or item.get('create', True) else "skip"
+            elif item.get('commit') and not args.clearChanges and self._head(git_dir) == item['commit']:
+                # same check as _checkout_commit, read from the files instead of asking git
+                action = "skip"
+            else:
+                action = "update"
+
+            counts[action] = counts.get(action, 0) + 1
+            print "%-7s %-40s %-12s %s" % (action, os.path.relpath(item['path'], root_dir), target[:12],
+                                           _strip_auth(item.get('origin', item['url'])))
+
+        print "\n%d to clone, %d to update, %d to skip" % (counts.get("clone", 0), counts.get("update", 0),
+                                                        counts.get("skip", 0))
+
+
+class AgentCommand(Command):
+    read_only = True
+    watch = True
+
+    def __init__(self):
+        Command.__init__(self, "agent")
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def validate_path(self, path, args):
+        if not os.path.isdir(os.path.join(path, ".git")):
+            raise argparse.ArgumentTypeError('Not a git repository')
+
+        return path
+
+    def _host_slot(self, url):
+        host = re.match("^(?:\w+://)?(?:[^@/]+@)?([^/:]+)", url).group(1)
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(max(self._host_jobs, 1))
+            return self._hosts[host]
+
+    def _fetch(self, item, args):
+        if not os.path.isdir(os.path.join(item['path'], ".git")):
+            return []
+
+        _output.failures = []
+        _output.buffer = []
+
+        # only remote tracking branches move, working trees are left to update --no-fetch
+        with self._host_slot(item['url']):
+            _fetch_branch(item['path'], item['url'], item['branch'], args)
+
+        _flush_output(_output.buffer)
+        failures = [(item['path'], f) for f in _output.failures]
+        _output.failures = None
+        _output.buffer = None
+
+        return failures
+
+    def resolved(self, model, args):
+        self._host_jobs = args.hostJobs
+        if args.workspace:
+            args.workspace.repos.reset()
+
+        started = time.time()
+        results = _parallel(lambda item: self._fetch(item, args), model["repositories"], args.jobs)
+        failures = sum(results, [])
+
+        print "%s fetched %d repositories in %.1fs, %d failed" % (
+            time.strftime("%Y-%m-%d %H:%M:%S"), len(model["repositories"]), time.time() - started, len(failures))
+        for path, failure in failures:
+            print "  %s\n    %s" % (path, failure)
+        sys.stdout.flush()
+
+
+class DeployCommand(UpdateCommand):
+    def __init__(self):
+        Command.__init__(self, "deploy")
+        self._changes = None
+        self._clone = CloneCommand()
+        self._root = None
+        self._shared = []
+        self._first = False
+
+    def validate_path(self, path, args):
+        if os.path.isdir(os.path.join(path, ".git")):
+            raise argparse.ArgumentTypeError('Deploy root should not contain git repository')
+
+        if os.path.lexists(os.path.join(path, "current")) and not os.path.islink(os.path.join(path, "current")):
+            raise argparse.ArgumentTypeError('current should be a symlink to a release')
+
+        return path
+
+    def _releases(self, released=False):
+        releases_dir = os.path.join(self._root, "releases")
+        names = sorted(os.listdir(releases_dir)) if os.path.isdir(releases_dir) else []
+
+        # failed and unfinished releases never went live, they are not counted for rollback or --keep
+        return [name for name in names if not released or
+                os.path.isfile(os.path.join(releases_dir, name, ".owr", "released"))]
+
+    def _current(self):
+        link = os.path.join(self._root, "current")
+        if not os.path.islink(link) or not os.path.isdir(link):
+            return None
+
+        return os.path.basename(os.readlink(link).rstrip(os.sep))
+
+    def _switch(self, name):
+        link = os.path.join(self._root, "current")
+        tmp_link = link + ".owr-tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+
+        # rename replaces the symlink in one step, requests see either the old or the new release
+        os.symlink(os.path.join("releases", name), tmp_link)
+        os.rename(tmp_link, link)
+
+        print "current -> releases/%s" % name
+
+    def prepare(self, args):
+        self._root = os.path.abspath(args.path)
+        self._shared = [os.path.normpath(p) for p in args.shared.split(",") if p]
+        current = self._current()
+
+        if args.rollback:
+            previous = [name for name in self._releases(True) if current and name < current]
+            if not previous:
+                print "error: there is no release before %s" % (current or "current")
+                sys.exit(1)
+
+            self._switch(previous[-1])
+            return False
+
+        name = time.strftime("%Y%m%d%H%M%S")
+        release = os.path.join(self._root, "releases", name)
+        suffix = 1
+        while os.path.lexists(release):
+            release = os.path.join(self._root, "releases", "%s-%d" % (name, suffix))
+            suffix += 1
+
+        self._first = current is None
+        if self._first:
+            os.makedirs(release)
+        else:
+            with _timings.phase("seed", release):
+                _seed_release(os.path.join(self._root, "releases", current), release,
+                              [os.path.join("ow_smarty", "template_c"), os.path.join(".owr", "released")])
+
+        print "building release %s" % os.path.basename(release)
+        args.path = release
+
+        return True
+
+    def main(self, root_dir, url, args, branch, sparse=None, *opt):
+        if self._first:
+            self._clone.main(root_dir, url, args, branch, sparse)
+        else:
+            UpdateCommand.main(self, root_dir, url, args, branch, sparse)
+
+    def item(self, path, url, args, branch, create=True, sparse=None, *opt):
+        UpdateCommand.item(self, path, url, args, branch, create or self._first, sparse)
 
-        os.chdir(args.runDir)
-        os.system("rm -rf %s" % tmp_dir)
+    def _link_shared(self, release):
+        for name in self._shared:
+            path = os.path.join(release, name)
+            shared_path = os.path.join(self._root, "shared", name)
+
+            if not os.path.lexists(shared_path):
+                if not os.path.isdir(os.path.dirname(shared_path)):
+                    os.makedirs(os.path.dirname(shared_path))
+
+                # the first release hands its files over, config.php starts as a copy of the default one
+                if os.path.lexists(path) and not os.path.islink(path):
+                    shutil.move(path, shared_path)
+                elif os.path.isfile(path + ".default"):
+                    shutil.copyfile(path + ".default", shared_path)
+                else:
+                    continue
+
+            if os.path.islink(path) or os.path.isfile(path):
+                os.remove(path)
+            elif os.path.isdir(path):
+                shutil.rmtree(path)
+            elif not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            os.symlink(os.path.relpath(shared_path, os.path.dirname(path)), path)
+
+    def completed(self, root_dir, url, args):
+        self._link_shared(root_dir)
+
+        templatec_path = os.path.join(root_dir, "ow_smarty", "template_c")
+        if not os.path.isdir(templatec_path):
+            os.makedirs(templatec_path)
+
+        if not args.disableChmod:
+            # shared folders are walked once, when the first release hands them over
+            _fix_permissions(root_dir, args, dirs=None if self._first else
+                             [d for d in WRITABLE_DIRS if d not in self._shared])
+
+    def finish(self, root_dir, failures, args):
+        name = os.path.basename(root_dir)
+        if failures:
+            print "release %s failed, current was not switched" % name
+            return
+
+        with open(os.path.join(root_dir, ".owr", "released"), "w") as f:
+            f.write(time.strftime("%Y-%m-%d %H:%M:%S"))
+        self._switch(name)
+
+        # the current release and the given number of released ones before it stay for rollback,
+        # older and failed ones go
+        released = self._releases(True)
+        kept = released[max(released.index(name) - args.keep, 0):]
+        for old in self._releases():
+            if old < name and old not in kept:
+                shutil.rmtree(os.path.join(self._root, "releases", old), True)
+
+        self._changes_hook(root_dir, args)
 
 
 # not completed
@@ -626,12 +2749,20 @@ class Builder:
     _commands = {}
     _parser = None
     _sections = None
+    _lock_source = None
+    _bundle_dir = None
+    _changes = None
+    _changes_lock = None
+    _section_records = None
+    failures = None
     _sectionFolders = {
         "plugins": "ow_plugins",
         "themes": "ow_themes"
     }
 
     def __init__(self, arguments, commands):
+        self._changes_lock = threading.Lock()
+        self._section_records = {}
         self._parser = SourceListParser(arguments)
         self._arguments = arguments
         self._commands = dict(zip(map(lambda c: c.name, commands), commands))
@@ -644,11 +2775,18 @@ class Builder:
                 self._auth = "%s:%s" % (self._arguments.username, urllib2.quote(self._arguments.password))
             self._auth_prefix = "%s@" % self._auth
 
+    def _mirror_urls(self, record):
+        # mirrors get no credentials, those are only meant for the primary host
+        urls = ["https://%s/%s.git" % (prefix, record["name"]) for prefix in record["config"][1:] if "=" not in prefix]
+
+        return map(_get_ssh_url, urls) if self._arguments.ssh else urls
+
     @ssh_url
     def core(self):
         try:
             core_record = self._sections["core"].values()[0]
             del self._sections["core"]
+            self._section_records["core"] = core_record
             core_branch = core_record["branch"]
             core_url = "https://%s%s/%s.git" % (self._auth_prefix, core_record["config"][0], core_record["name"])
         except KeyError:
@@ -661,6 +2799,7 @@ class Builder:
         try:
             install_record = self._sections["install"].values()[0]
             del self._sections["install"]
+            self._section_records["install"] = install_record
             install_branch = install_record["branch"]
             install_url = "https://%s%s/%s.git" % (
                 self._auth_prefix, install_record["config"][0], install_record["name"])
@@ -686,48 +2825,339 @@ class Builder:
                 url = "https://%s%s/%s.git" % (self._auth_prefix, repo_prefix, record["name"])
                 if self._arguments.ssh:
                     url = _get_ssh_url(url)
-                r.append({'path': path, 'url': url, 'branch': record['branch']})
+                r.append({'path': path, 'url': url, 'branch': record['branch'], 'mirrors': self._mirror_urls(record),
+                          'source': record.get('source'), 'sparse': self._sparse(record, path)})
         return r
 
-    def process(self):
-        command = self._commands[self._arguments.command]
+    def _head(self, git_dir):
+        if not os.path.isdir(git_dir):
+            return None
+
+        return _git_output("--git-dir=%s" % git_dir, "rev-parse", "-q", "--verify", "HEAD")
+
+    def _record_change(self, item, before, after):
+        files = None
+        if before:
+            diff = _git_output("--git-dir=%s" % os.path.join(item['path'], ".git"), "diff", "--name-only",
+                               before, after)
+            files = diff.splitlines() if diff is not None else None
+
+        with self._changes_lock:
+            self._changes.append({
+                "path": os.path.relpath(item['path'], os.path.abspath(self._arguments.path)),
+                "url": _strip_auth(item.get('origin', item['url'])),
+                "branch": item['branch'],
+                "before": before,
+                "after": after,
+                "files": files
+            })
+
+    def _process_item(self, command, item, buffered):
+        _output.failures = []
+        _output.buffer = [] if buffered else None
+
+        git_dir = os.path.join(item['path'], ".git")
+        before = self._head(git_dir) if command.name in ['update', 'deploy'] else None
+        _progress.begin(item['path'])
+
+        try:
+            with _timings.phase("main" if item.get('core') else "item", item['path'], git_dir):
+                if self._arguments.archive and command.name == 'clone':
+                    if not os.path.isdir(item['path']):
+                        os.makedirs(item['path'])
+                    _download_archive(item['url'], item['path'], item.get('commit') or item['branch'],
+                                      self._arguments, item.get('sparse'))
+                elif item.get('commit') and os.path.isdir(git_dir):
+                    _sparse_checkout(item['path'], item.get('sparse'), self._arguments)
+                    _checkout_commit(item['path'], item['commit'], self._arguments)
+                else:
+                    origin = item.get('origin')
+                    _output.transfer_failed = False
+                    for url in [item['url']] + item.get('mirrors', []):
+                        if url != item['url']:
+                            # migrate pushes, a mirror is never written to; a failed checkout is no network issue
+                            if not _output.failures or not _output.transfer_failed or \
+                                    command.name not in ['clone', 'update', 'deploy', 'bundle']:
+                                break
+
+                            _print("Retrying %s from mirror %s" % (item['path'], _strip_auth(url)))
+                            _output.failures = []
+                            _output.transfer_failed = False
+                            origin = item.get('origin', item['url'])
+
+                        if item.get('core'):
+                            command.main(item['path'], url, self._arguments, item['branch'], item.get('sparse'))
+                        else:
+                            command.item(item['path'], url, self._arguments, item['branch'], item.get('create', True),
+                                         item.get('sparse'))
+
+                    if origin and os.path.isdir(git_dir):
+                        # whatever it was cloned from, origin always points to the repository from the source list
+                        _run(_git(item['path'], "remote", "set-url", "origin", origin))
+
+                    if item.get('commit') and os.path.isdir(git_dir):
+                        _checkout_commit(item['path'], item['commit'], self._arguments)
+
+            if self._arguments.workspace and command.name in ['update', 'clone', 'deploy'] and os.path.isdir(git_dir):
+                with _timings.phase("link", item['path']):
+                    self._arguments.workspace.link(item['path'])
+
+            changed = True
+            if command.name in ['update', 'deploy']:
+                after = self._head(git_dir)
+                changed = before != after
+                if after and changed:
+                    self._record_change(item, before, after)
+
+            with _timings.phase("composer", item['path']):
+                command.composer(item['path'], changed)
+        except Exception as e:
+            _output.failures.append("%s: %s" % (e.__class__.__name__, e))
+
+        _flush_output(_output.buffer)
+        _progress.end(not _output.failures)
+        failures = [(item['path'], f) for f in _output.failures]
+        _output.failures = None
+        _output.buffer = None
+
+        return failures
+
+    def _process_items(self, command, items):
+        buffered = command.parallel and self._arguments.jobs > 1 and len(items) > 1
+        jobs = self._arguments.jobs if command.parallel else 1
+
+        for failures in _parallel(lambda item: self._process_item(command, item, buffered), items, jobs):
+            self.failures.extend(failures)
+
+    def locked_items(self, lock_path):
+        with open(lock_path) as f:
+            lock = json.load(f)
+
+        self._lock_source = lock.get("source")
+
+        items = []
+        for record in lock["repositories"]:
+            url = record["url"]
+            if url.startswith("https://") and self._auth_prefix:
+                url = "https://%s%s" % (self._auth_prefix, url[len("https://"):])
+
+            item = {'path': os.path.abspath(os.path.join(self._arguments.path, record["path"])), 'url': url,
+                    'branch': record["branch"], 'commit': record["commit"], 'sparse': record.get("sparse")}
+            if record["path"] == ".":
+                item['core'] = True
+            elif record["path"] == "ow_install":
+                item['create'] = False
+
+            if record.get("bundle"):
+                # cloned from the bundle, origin is pointed back to the real repository afterwards
+                item['origin'] = url
+                item['url'] = os.path.join(os.path.dirname(lock_path), record["bundle"])
+            items.append(item)
+
+        return items
+
+    def bundled_items(self):
+        self._bundle_dir = tempfile.mkdtemp()
+        with tarfile.open(self._arguments.source) as archive:
+            archive.extractall(self._bundle_dir)
+
+        return self.locked_items(os.path.join(self._bundle_dir, "lock.json"))
+
+    def write_lock(self, items):
+        repositories = []
+        for item in items:
+            commit = _git_output("--git-dir=%s" % os.path.join(item['path'], ".git"), "rev-parse", "-q", "--verify",
+                                 "HEAD") or _archive_commit(item['path'])
+            if not commit:
+                continue
+
+            repository = {
+                "path": os.path.relpath(item['path'], os.path.abspath(self._arguments.path)),
+                "url": _strip_auth(item.get('origin', item['url'])),
+                "branch": item['branch'],
+                "commit": commit
+            }
+            if item.get('sparse') is not None:
+                repository["sparse"] = item['sparse']
+            repositories.append(repository)
+
+        owr_dir = os.path.join(self._arguments.path, ".owr")
+        if not os.path.isdir(owr_dir):
+            os.mkdir(owr_dir)
+
+        with open(os.path.join(owr_dir, "lock.json"), "w") as f:
+            source = self._lock_source or _strip_auth(self._arguments.source)
+            json.dump({"source": source, "repositories": sorted(repositories, key=lambda r: r["path"])}, f,
+                      indent=4, sort_keys=True)
+            f.write("\n")
+
+    def write_changes(self, total):
+        owr_dir = os.path.join(self._arguments.path, ".owr")
+        if not os.path.isdir(owr_dir):
+            os.mkdir(owr_dir)
 
-        self._sections = self._parser.fetch()
-        command.fetched(self._sections, self._arguments)
+        with open(os.path.join(owr_dir, "changes.json"), "w") as f:
+            json.dump({"repositories": sorted(self._changes, key=lambda c: c["path"])}, f, indent=4, sort_keys=True)
+            f.write("\n")
 
+        print "%d of %d repositories changed" % (len(self._changes), total)
+
+    def _sparse(self, record, path):
+        name = record.get("sparse")
+        if name and name not in self._parser.profiles:
+            self.failures.append((path, "Unknown sparse profile: %s" % name))
+
+        return self._parser.profiles.get(name) if name else None
+
+    def _section_item(self, name, item):
+        record = self._section_records.get(name)
+        if record:
+            item.update({'mirrors': self._mirror_urls(record), 'source': record.get('source'),
+                         'sparse': self._sparse(record, item['path'])})
+
+        return item
+
+    def resolve(self, command):
+        if self._arguments.fromLock or self._arguments.fromBundle:
+            # source list resolution is skipped entirely, the lock file has everything
+            items = self.bundled_items() if self._arguments.fromBundle else self.locked_items(self._arguments.source)
+            core_item = ([item for item in items if item.get('core')] or [None])[0]
+            items = [item for item in items if not item.get('core')]
+        else:
+            # core and install are taken out of the sections, the parsed lists themselves stay untouched
+            self._sections = dict(self._parser.fetch())
+            command.fetched(self._sections, self._arguments)
+
+            core_branch, core_url = self.core()
+            install_branch, install_url = self.install()
+
+            core_item = self._section_item("core", {'path': os.path.abspath(self._arguments.path), 'url': core_url,
+                                                    'branch': core_branch, 'core': True})
+            items = [self._section_item("install", {
+                'path': os.path.abspath(os.path.join(self._arguments.path, "ow_install")), 'url': install_url,
+                'branch': install_branch, 'create': False})]
+            items.extend(self.records())
+            self.failures.extend(self._parser.errors)
+
+        return core_item, items
+
+    @property
+    def command(self):
+        return self._commands[self._arguments.command]
+
+    def process(self):
+        command = self.command
+        self.failures = []
+        self._changes = []
         self.auth()
-        core_branch, core_url = self.core()
 
-        command.main(os.path.abspath(self._arguments.path), core_url, self._arguments, core_branch)
-        command.composer(os.path.abspath(self._arguments.path))
+        if not command.prepare(self._arguments):
+            return
+
+        while True:
+            core_item, items = self.resolve(command)
+            if not command.read_only or command.watch:
+                # resolve and plan never run git against the remotes
+                _ssh.connect([item['url'] for item in filter(None, [core_item]) + items])
+
+            if command.read_only:
+                command.resolved({"source": self._lock_source or _strip_auth(self._arguments.source),
+                                  "lists": self._parser.lists, "repositories": filter(None, [core_item]) + items},
+                                 self._arguments)
+            else:
+                self.build(command, core_item, items)
+
+            if self._bundle_dir:
+                shutil.rmtree(self._bundle_dir, True)
+
+            if not command.watch or not self._arguments.interval:
+                break
+
+            try:
+                time.sleep(self._arguments.interval)
+            except KeyboardInterrupt:
+                break
+
+            # the lists are resolved again, so the repositories follow changes in them
+            self._parser = SourceListParser(self._arguments)
+            self._section_records = {}
 
-        install_branch, install_url = self.install()
+    def build(self, command, core_item, items):
+        planned = command.plan(filter(None, [core_item]) + items, self._arguments)
+        _progress.start(self._arguments.path, len(planned))
 
-        command.item(os.path.abspath(os.path.join(self._arguments.path, "ow_install")), install_url, self._arguments,
-                     install_branch, False)
+        # plugins and themes live inside the core tree, so core always goes first
+        if core_item and core_item in planned:
+            core_failures = self._process_item(command, core_item, False)
+            self.failures.extend(core_failures)
+            if core_failures:
+                # plugins and themes would end up in a folder without core
+                planned = [core_item]
 
-        records = self.records()
-        for r in records:
-            command.item(r['path'], r['url'], self._arguments, r['branch'])
-            command.composer(r['path'])
+        self._process_items(command, [item for item in items if item in planned])
+        _progress.finish()
 
         command.clear_temp()
-        command.completed(self._arguments.path, core_url, self._arguments)
+        if command.name in ['update', 'deploy']:
+            self.write_changes(len(planned))
+            command.updated(self._changes, self._arguments)
+
+        with _timings.phase("completed", os.path.abspath(self._arguments.path)):
+            command.completed(self._arguments.path, core_item['url'] if core_item else None, self._arguments)
+
+        if command.name in ['update', 'clone', 'deploy'] and os.path.isdir(self._arguments.path):
+            self.write_lock(filter(None, [core_item]) + items)
+
+        command.finish(self._arguments.path, self.failures, self._arguments)
+
+        if self._arguments.objectCache:
+            self._arguments.objectCache.evict()
+
+    def report(self):
+        if not self.failures:
+            return
+
+        print "\nerror: %d operation(s) failed:" % len(self.failures)
+        for path, failure in self.failures:
+            print "  %s\n    %s" % (path, failure)
+
+
+def setup(arguments):
+    _timings.enabled = bool(arguments.timings)
+    _runner.configure(arguments.maxProcesses, arguments.timeout)
+    _throttle.configure(arguments.retries, arguments.retryDelay, arguments.maxProcesses)
+    _progress.mode = arguments.progress
+    _http.proxy = arguments.proxy
+    _http.timeout = arguments.timeout or None
+    if arguments.ssh:
+        _ssh.start(arguments.sshCommand or os.environ.get("GIT_SSH_COMMAND") or "ssh")
 
 
 def main():
-    commands = [CloneCommand(), UpdateCommand(), MigrateCommand()]
+    commands = [CloneCommand(), UpdateCommand(), MigrateCommand(), BundleCommand(), ResolveCommand(), PlanCommand(),
+                AgentCommand(), DeployCommand()]
     arguments = Arguments(commands)
 
     arguments.read_configs()
     arguments.parse()
+    setup(arguments)
 
     builder = Builder(arguments, commands)
     builder.process()
 
-    arguments.save_configs()
+    read_only = builder.command.read_only
+    if not read_only:
+        arguments.save_configs()
+
+    if arguments.timings:
+        _timings.write(arguments.timings, arguments.timingsFile)
+
+    if builder.failures:
+        builder.report()
+        sys.exit(1)
 
-    print "\n%s command was completed !!!" % arguments.command
+    if not read_only:
+        print "\n%s command was completed !!!" % arguments.command
 
 
 if __name__ == "__main__":